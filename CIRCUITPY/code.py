@@ -14,6 +14,7 @@ import ssl
 from adafruit_datetime import datetime
 import traceback
 from comms import file_receive
+from adr import LinkAdapter
 import os
 
 
@@ -28,9 +29,13 @@ node = const(0xfb)
 destination = const(0xfa)
 
 rfm9x = pycubed_rfm9x.RFM9x(board.SPI(), CS, RST, 437.4)
-rfm9x.spreading_factor = 8
 rfm9x.node = node
 rfm9x.destination = destination
+# starts on SF8 and, with ADR_ENABLED, steps up or down with the measured SNR
+link = LinkAdapter(rfm9x, log=True)
+# leave off until the flight software answers ADR proposals, until then a
+# proposal costs the satellite an unexpected packet and IRVCB ack_timeout
+ADR_ENABLED = False
 
 def attempt_wifi():
     # TODO: Move wifi pass and id to config
@@ -85,90 +90,68 @@ def synctime(pool):
     except Exception as e:
         print('[WARNING]', e)
 
-def main():
-<<<<<<< HEAD
-	pool = attempt_wifi()
-	#print("Waiting for messages...")
-	while True:
-		try:
-			print('Waiting for messages....')
-			packet = rfm9x.receive(timeout=10)
-			if packet is None:
-				continue
-			
-			print("Telemetry packet received.")
-			filename = datetime.now().isoformat().replace(":","-")
-			filepath =f'received_telemetry/{filename}.txt'
-			with open(filepath, 'w') as f:
-				f.write(packet)
-				print(f"Telemetry packet written to {filepath}")
-			rfm9x.send("IRVCB")
-
-			packet = rfm9x.receive(timeout=10)
-			if packet[0] != 1: # not an image packet
-				print("Non-image packet received, rejected")
-				continue
-			print("First image packet received")
-			
-			size = int.from_bytes(packet[1:5], 'little')
-			packet_count = (size-1)//244+1
-			print(f"Image is of size {size} bytes, requiring {packet_count} packets")
-			folder_path = f"received_images/{filename}"
-			os.mkdir(folder_path)
-			with open(f"{folder_path}/packet_1.raw","wb") as f:
-				f.write(packet[5:])
-			print("Wrote first image packet")
-			request_packet_list = [0]*packet_count # 0 for not received correctly, 1 for received correctly
-			request_packet_list[0] = 1
-			for packet_index in range(2, packet_count+1):
-				packet = rfm9x.receive(timeout=10)
-				if packet[0] == 1:
-					packet_number = int.from_bytes(packet[1:5], 'little')
-					packet_path = f"{folder_path}/packet_{packet_number}.raw"
-					with open(packet_path, "wb") as f:
-						f.write(packet[5:])
-					request_packet_list[packet_number-1] = 1
-					print('received')
-				'''elif len(packet) != 249:
-					packet_path = f"corrupted/{datetime.now().isoformat()}.raw"
-					with open(packet_path, "w") as f:
-						f.write(packet)
-						print(f"Packet {packet_path} has length {len(packet)}, not 249")
-				elif packet[0] != 1:
-					packet_path = f"corrupted/{datetime.now().isoformat()}.raw"
-					with open(packet_path, "w") as f:
-						f.write(packet)
-						print("not 1 at beginning")'''
-			with open(f'received_images/{filename}.jpg', 'wb') as stream1:
-				image_collection = os.listdir(folder_path)
-				for image_file in image_collection:
-					with open(f'received_images/{filename}/{image_file}', 'rb') as stream2:
-						image_data = stream2.read()
-					stream1.write(image_data)
-			print('image created')
-
-			packet = rfm9x.receive(timeout=10)
-			print(packet)
-
-		except Exception as e:
-			print("Error in Main Loop: " + ''.join(traceback.format_exception(e)))
+class ImageAssembler:
+    """Writes image packets straight into their place in one image file.
+
+    Packet n carries bytes (n-1)*244 onward, so every packet is a single
+    seek and write into a file allocated at the full image size, and the
+    image is complete as soon as the last hole is filled.
+    """
+    packet_data_len = 244
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.packet_count = (size - 1) // self.packet_data_len + 1
+        self.received = bytearray((self.packet_count + 7) // 8)
+        self.file = open(path, 'wb+')
+        # FatFs extends the file on a seek past the end
+        self.file.seek(size - 1)
+        self.file.write(b'\x00')
+
+    def add(self, packet_number, data):
+        index = packet_number - 1
+        if not 0 <= index < self.packet_count:
+            return False
+        offset = index * self.packet_data_len
+        # the last packet is padded out to the full packet length
+        self.file.seek(offset)
+        self.file.write(data[:self.size - offset])
+        self.received[index >> 3] |= 1 << (index & 7)
+        return True
+
+    def has(self, packet_number):
+        index = packet_number - 1
+        return bool(self.received[index >> 3] & (1 << (index & 7)))
+
+    def missing(self):
+        return [n for n in range(1, self.packet_count + 1) if not self.has(n)]
+
+    def finalize(self):
+        self.file.close()
+        return self.missing()
 
-if __name__ == "__main__":
-	main()
-=======
+def main():
     pool = attempt_wifi()
     while True:
         try:
             print('Waiting for messages....')
             packet = rfm9x.receive(timeout=10)
             if packet is None:
+                link.observe_loss()
+                continue
+            if ADR_ENABLED and link.handle(packet):
                 continue
+            link.observe()
             
             print("Telemetry packet received.")
             filepath =f'received_telemetry/{datetime.now().isoformat()}.txt'.replace(":", "-")
             with open(filepath, 'w') as f:
                 f.write(packet)
                 print(f"Telemetry packet written to {filepath}")
+            # the satellite is waiting for our reply, a good time to renegotiate
+            if ADR_ENABLED:
+                link.maybe_step()
             rfm9x.send("IRVCB")
 
             packet = rfm9x.receive(timeout=10)
@@ -180,32 +163,25 @@ if __name__ == "__main__":
             size = int.from_bytes(packet[1:5], 'little')
             packet_count = (size-1)//244+1
             print(f"Image is of size {size} bytes, requiring {packet_count} packets")
-            image_name = datetime.now().isoformat()
-            folder_path = f"received_images/{image_name}"
-            os.mkdir(folder_path)
-            packet_path = f"{folder_path}/packet_1.raw"
-            with open(packet_path,"wb") as f:
-                f.write(packet[5:])
-                print(f"Packet {packet_path} successfully saved")
-            
-            request_packet_list = [0]*packet_count # 0 for not received correctly, 1 for received correctly
-            request_packet_list[0] = 1
+            image_name = datetime.now().isoformat().replace(":", "-")
+            image_path = f"received_images/{image_name}.jpg"
+            image = ImageAssembler(image_path, size)
+            image.add(1, packet[5:])
+            print("Packet 1 successfully saved")
+
             while True:
                 packet = rfm9x.receive(timeout=10)
                 if packet is None:
-                    print("Stopped receiving packets. Packet status list:")
-                    print(request_packet_list)
+                    print("Stopped receiving packets.")
+                    link.observe_loss()
                     break
+                link.observe()
                 if packet[0] == 1 and len(packet) == 249:
                     packet_number = int.from_bytes(packet[1:5], 'little')
-                    packet_path = f"{folder_path}/packet_{packet_number}.raw"
-                    with open(packet_path, "wb") as f:
-                        f.write(packet[5:])
-                        print(f"Packet {packet_path} successfully saved")
-                    request_packet_list[packet_number-1] = 1
+                    if image.add(packet_number, packet[5:]):
+                        print(f"Packet {packet_number} successfully saved")
                     if packet_number == packet_count:
-                        print("Final packet was received. Packet status list:")
-                        print(request_packet_list)
+                        print("Final packet was received.")
                         break
                 elif len(packet) != 249:
                     packet_path = f"corrupted/{datetime.now().isoformat()}.raw"
@@ -217,7 +193,10 @@ if __name__ == "__main__":
                     with open(packet_path, "wb") as f:
                         f.write(packet)
                         print(f"Packet {packet_path} starts with non-1")
-                
+            missing = image.finalize()
+            print(f"Image written to {image_path}, missing packets: {missing}")
+            print(f"Link: {rfm9x.stats.summary()}")
+
             packet = rfm9x.receive(timeout=10)
             print("Packet following image: ", packet)
 
@@ -226,4 +205,3 @@ if __name__ == "__main__":
 
 if __name__ == "__main__":
     main()
->>>>>>> 6c70382d5516e562001d48abc6bb5051947d1263
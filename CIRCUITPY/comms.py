@@ -6,44 +6,124 @@ from datetime import datetime
 import sys
 from pathlib import Path
 
+try:
+    import microcontroller
+except ImportError:
+    microcontroller = None
+
 # Load your service account credentials
+CREDENTIALS = 'ihscubesat-c9dc08a671e1.json'
+NVM_MAGIC = b'TK'
 
 
-def post_image(filepath, pool):
-    with open('ihscubesat-c9dc08a671e1.json', 'r') as f:
-        sa_credentials = json.load(f)
-    # Prepare the JWT Claims
-    iat = time.time()
-    exp = iat + 3600
-    filepath = filepath
-    filename = Path(filepath).name
-    payload = {
-        'iss': sa_credentials['client_email'],
-        'sub': sa_credentials['client_email'],
-        'aud': 'https://oauth2.googleapis.com/token',
-        'iat': iat,
-        'exp': exp,
-        'scope': 'https://www.googleapis.com/auth/drive.file'
-    }
-    # Sign the JWT
-    jwt_instance = JWT()
-    #convert to bytes
-    private_key = jwk_from_pem(bytes(sa_credentials['private_key'], 'utf-8'))
-    signed_jwt = jwt_instance.encode(payload, private_key, 'RS256')
-    # Get the access token
-    requests = adafruit_requests.Session(pool)
-    token_response = requests.post(
-        'https://oauth2.googleapis.com/token',
-        headers={'Content-Type': 'application/x-www-form-urlencoded'},
-        data={
-            'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
-            'assertion': signed_jwt
+class TokenManager:
+    """Google access token for the service account, fetched only when it runs out
+
+    Signing the RS256 JWT takes seconds on the ESP32, so the access token
+    is kept until `margin` seconds before it expires, and optionally in
+    NVM so a reset does not cost a new one. The one Session is reused for
+    the token and every upload. NVM holds NVM_MAGIC, a u16 length and
+    the JSON {"token", "exp"} from `nvm_offset`.
+
+    Args:
+        pool (SocketPool): socket pool for the session
+        margin (int, optional): seconds before expiry to fetch a new token. Defaults to 300.
+        use_nvm (bool, optional): keep the token in microcontroller.nvm. Defaults to False.
+        nvm_offset (int, optional): where in NVM. Defaults to 0.
+    """
+
+    def __init__(self, pool, margin=300, use_nvm=False, nvm_offset=0):
+        self.session = adafruit_requests.Session(pool)
+        self.margin = margin
+        self.use_nvm = use_nvm and microcontroller is not None
+        self.nvm_offset = nvm_offset
+        self.credentials = None
+        self.private_key = None
+        self.access_token = None
+        self.exp = 0
+        if self.use_nvm:
+            self.load_nvm()
+
+    def token(self):
+        """A valid access token, fetches a new one if needed"""
+        if self.access_token is None or time.time() >= self.exp - self.margin:
+            self.refresh()
+        return self.access_token
+
+    def invalidate(self):
+        """Drop the token, e.g. after the server refused it"""
+        self.access_token = None
+        self.exp = 0
+
+    def refresh(self):
+        if self.credentials is None:
+            with open(CREDENTIALS, 'r') as f:
+                self.credentials = json.load(f)
+            #convert to bytes
+            self.private_key = jwk_from_pem(bytes(self.credentials['private_key'], 'utf-8'))
+        # Prepare the JWT Claims
+        iat = time.time()
+        exp = iat + 3600
+        payload = {
+            'iss': self.credentials['client_email'],
+            'sub': self.credentials['client_email'],
+            'aud': 'https://oauth2.googleapis.com/token',
+            'iat': iat,
+            'exp': exp,
+            'scope': 'https://www.googleapis.com/auth/drive.file'
         }
-    )
-    access_token = token_response.json().get('access_token')
+        # Sign the JWT
+        signed_jwt = JWT().encode(payload, self.private_key, 'RS256')
+        # Get the access token
+        token_response = self.session.post(
+            'https://oauth2.googleapis.com/token',
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            data={
+                'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                'assertion': signed_jwt
+            }
+        )
+        token = token_response.json()
+        token_response.close()
+        self.access_token = token.get('access_token')
+        self.exp = iat + token.get('expires_in', 3600)
+        if self.use_nvm:
+            self.save_nvm()
+
+    def load_nvm(self):
+        nvm = microcontroller.nvm
+        start = self.nvm_offset
+        if bytes(nvm[start:start + 2]) != NVM_MAGIC:
+            return
+        length = nvm[start + 2] << 8 | nvm[start + 3]
+        try:
+            saved = json.loads(str(bytes(nvm[start + 4:start + 4 + length]), 'utf-8'))
+        except ValueError:
+            return
+        self.access_token = saved['token']
+        self.exp = saved['exp']
+
+    def save_nvm(self):
+        data = json.dumps({"token": self.access_token, "exp": self.exp}).encode('utf-8')
+        start = self.nvm_offset
+        microcontroller.nvm[start:start + 4 + len(data)] = NVM_MAGIC + bytes((len(data) >> 8, len(data) & 0xFF)) + data
+
+
+# shared by every post_image() call that does not pass its own
+_tokens = None
+
+
+def post_image(filepath, pool, tokens=None):
+    global _tokens
+    if tokens is None:
+        if _tokens is None:
+            _tokens = TokenManager(pool)
+        tokens = _tokens
+    requests = tokens.session
+    filename = Path(filepath).name
     # Upload the file to Google Drive
     headers = {
-        "Authorization": "Bearer " + access_token
+        "Authorization": "Bearer " + tokens.token()
     }
     metadata = {
         'name': filename,
@@ -60,7 +140,18 @@ def post_image(filepath, pool):
         headers=headers,
         files=files
     )
+    if response.status_code == 401:
+        # revoked or the clock was off, try once more with a new token
+        response.close()
+        tokens.invalidate()
+        headers["Authorization"] = "Bearer " + tokens.token()
+        response = requests.post(
+            'https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart',
+            headers=headers,
+            files=files
+        )
     print(response.text)
+    response.close()
 
 
 def file_receive(filepath, size, rfm9x):
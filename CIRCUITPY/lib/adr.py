@@ -0,0 +1,179 @@
+"""
+`adr`
+====================================================
+
+Adaptive data rate for the RFM9x link
+
+Implementation Notes
+--------------------
+Both ends run a LinkAdapter over the same profile table and boot on the
+same default profile. A change is negotiated over the air: the proposing
+end sends ``b"ADR" + bytes([index])`` on the current settings, the other
+end echoes it back on the current settings and then switches, and the
+proposer switches once it hears the echo. If the echo is lost the two ends
+disagree, hear nothing from each other and both fall back to the default
+profile after `fallback_losses` receive timeouts.
+
+"""
+# (spreading factor, bandwidth, coding rate denominator), slowest first
+PROFILES = (
+    (12, 125000, 8),
+    (11, 125000, 6),
+    (10, 125000, 5),
+    (9, 125000, 5),
+    (8, 125000, 5),
+    (7, 125000, 5),
+    (7, 250000, 5),
+    (7, 500000, 5),
+)
+
+# SNR (dB) below which the SX127x cannot demodulate, per spreading factor
+SNR_FLOOR = {6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+# dB of extra noise let in by a bandwidth, relative to 125 kHz. The radio
+# measures SNR at the bandwidth in use, so this only matters when guessing
+# the SNR a profile on another bandwidth would see.
+BW_PENALTY = {125000: 0.0, 250000: 3.0, 500000: 6.0}
+
+ADR_CMD = b"ADR"
+
+
+class LinkAdapter:
+    """Picks the fastest LoRa profile the measured link margin allows
+
+    Call observe() with the SNR of every received packet, observe_loss()
+    on every receive timeout, and hand each received packet to handle()
+    first so link commands from the other end are answered. maybe_step()
+    negotiates a faster profile while the margin holds and a slower one
+    when it does not.
+
+    Args:
+        radio (RFM9x): radio to configure
+        default (int, optional): index into PROFILES used at boot and on fallback. Defaults to 4 (SF8, 125 kHz, 4/5).
+        log (bool, optional): print profile changes. Defaults to False.
+    """
+
+    def __init__(self, radio, default=4, log=False):
+        self.radio = radio
+        self.default = default
+        self.log = log
+        # dB of margin over the next faster profile's floor before stepping up
+        self.up_margin = 6.0
+        # dB of margin over the current floor below which we step down
+        self.down_margin = 2.0
+        # packets in a row that must agree before stepping up
+        self.window = 8
+        # receive timeouts in a row before falling back to the default
+        self.fallback_losses = 3
+        self.ack_timeout = 2.0
+        self.index = None
+        self.snrs = []
+        self.losses = 0
+        self.apply(default)
+
+    def floor(self, index):
+        """Demodulation floor of a profile, as SNR measured at its own bandwidth"""
+        return SNR_FLOOR[PROFILES[index][0]]
+
+    def margin(self, index=None):
+        """Worst recent SNR over a profile's floor, None before any packets
+
+        Defaults to the current profile. For a profile on another bandwidth
+        the SNR is first shifted by the difference in BW_PENALTY, the noise
+        that bandwidth would add or take away.
+        """
+        if not self.snrs:
+            return None
+        if index is None:
+            index = self.index
+        shift = BW_PENALTY[PROFILES[index][1]] - BW_PENALTY[PROFILES[self.index][1]]
+        return min(self.snrs) - shift - self.floor(index)
+
+    def apply(self, index):
+        """Switch the local radio to PROFILES[index]"""
+        sf, bw, cr = PROFILES[index]
+        self.radio.spreading_factor = sf
+        self.radio.signal_bandwidth = bw
+        self.radio.coding_rate = cr
+        # required once a symbol lasts 16 ms or more
+        self.radio.low_datarate_optimize = (1 << sf) * 1000 // bw >= 16
+        self.index = index
+        self.snrs = []
+        self.losses = 0
+        if self.log: print(f"link profile {index}: SF{sf} BW{bw} CR4/{cr}")
+
+    def observe(self, snr=None):
+        """Record a received packet, defaults to the radio's last_snr"""
+        self.losses = 0
+        self.snrs.append(self.radio.last_snr if snr is None else snr)
+        if len(self.snrs) > self.window:
+            self.snrs.pop(0)
+
+    def observe_loss(self):
+        """Record a receive timeout, falls back to the default profile after fallback_losses
+
+        Returns:
+            bool: True if the profile was changed
+        """
+        self.losses += 1
+        if self.losses >= self.fallback_losses and self.index != self.default:
+            if self.log: print("link lost, falling back")
+            self.apply(self.default)
+            return True
+        return False
+
+    def recommend(self):
+        """Profile index the recent SNR calls for, the current one if unsure"""
+        margin = self.margin()
+        if margin is None:
+            return self.index
+        if margin < self.down_margin and self.index > 0:
+            return self.index - 1
+        if len(self.snrs) < self.window or self.index + 1 >= len(PROFILES):
+            return self.index
+        if self.margin(self.index + 1) >= self.up_margin:
+            return self.index + 1
+        return self.index
+
+    def maybe_step(self):
+        """Negotiate the recommended profile with the other end if it differs
+
+        Only call this while the other end is listening.
+
+        Returns:
+            bool: True if the profile was changed
+        """
+        index = self.recommend()
+        if index == self.index:
+            return False
+        return self.propose(index)
+
+    def propose(self, index):
+        """Ask the other end to switch to PROFILES[index] and switch if it agrees"""
+        cmd = ADR_CMD + bytes([index])
+        self.radio.send(cmd)
+        reply = self.radio.receive(timeout=self.ack_timeout)
+        if reply is None or bytes(reply) != cmd:
+            if self.log: print(f"profile {index} not acknowledged")
+            # try again once fresh measurements are in
+            self.snrs = []
+            return False
+        self.apply(index)
+        return True
+
+    def handle(self, packet):
+        """Answer a link command from the other end
+
+        Returns:
+            bool: True if packet was a link command and has been consumed
+        """
+        if packet is None or len(packet) != len(ADR_CMD) + 1 or bytes(packet[:len(ADR_CMD)]) != ADR_CMD:
+            return False
+        index = packet[len(ADR_CMD)]
+        if index >= len(PROFILES):
+            return True
+        # acknowledge on the old settings, then follow
+        self.radio.send(bytes(packet))
+        self.apply(index)
+        return True
+
@@ -0,0 +1,78 @@
+"""
+`fec`
+====================================================
+
+XOR parity erasure coding for file transfers
+
+Implementation Notes
+--------------------
+Chunks are split into groups of k consecutive chunks and one repair chunk,
+the XOR of the group, is sent after each group. Any single chunk lost from
+a group is rebuilt from the repair chunk and the k - 1 chunks that did
+arrive, without asking the sender. Chunks are treated as little endian
+integers so the XOR runs on CircuitPython's long ints instead of a byte
+loop, and a short last chunk XORs as if zero padded.
+
+"""
+
+
+class XorParity:
+    """One repair chunk per group of k data chunks
+
+    Args:
+        k (int): data chunks per group
+        chunk_size (int): size of every chunk but the last
+        num_packets (int): number of data chunks in the file
+    """
+
+    def __init__(self, k, chunk_size, num_packets):
+        self.k = k
+        self.chunk_size = chunk_size
+        self.num_packets = num_packets
+        self.num_groups = (num_packets + k - 1) // k
+        self.acc = 0
+
+    def group(self, seq):
+        """Group a data chunk belongs to"""
+        return seq // self.k
+
+    def members(self, group):
+        """Sequence numbers of the data chunks in a group"""
+        return range(group * self.k, min((group + 1) * self.k, self.num_packets))
+
+    def repair_seq(self, group):
+        """Sequence number the repair chunk of a group is sent with"""
+        return self.num_packets + group
+
+    def repair_group(self, seq):
+        """Group a repair sequence number belongs to, None for data chunks"""
+        group = seq - self.num_packets
+        if 0 <= group < self.num_groups:
+            return group
+        return None
+
+    def add(self, chunk):
+        """Fold a data chunk into the running repair chunk, see take()"""
+        self.acc ^= int.from_bytes(chunk, 'little')
+
+    def take(self):
+        """Repair chunk of the chunks added since the last take()"""
+        repair = self.acc.to_bytes(self.chunk_size, 'little')
+        self.acc = 0
+        return repair
+
+    def rebuild(self, repair, others, length):
+        """Rebuild the one missing chunk of a group
+
+        Args:
+            repair (bytes): the group's repair chunk
+            others (iterable): the other chunks of the group
+            length (int): length of the missing chunk
+
+        Returns:
+            bytes: the missing chunk
+        """
+        acc = int.from_bytes(repair, 'little')
+        for chunk in others:
+            acc ^= int.from_bytes(chunk, 'little')
+        return acc.to_bytes(self.chunk_size, 'little')[:length]
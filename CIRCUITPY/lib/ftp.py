@@ -13,6 +13,104 @@ Implementation Notes
 """
 import os
 import math
+import time
+import struct
+import binascii
+
+import lzss
+from fec import XorParity
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+# not worth compressing again
+INCOMPRESSIBLE = ('.jpg', '.jpeg', '.png', '.gz', '.zip', '.lzss', '.zlib')
+
+
+class TransferJournal:
+    """On-disk progress record of a file that is being received
+
+    The journal holds a file id (crc32 of the remote path), the file size,
+    the crc32 of the file as the sender has it (0 if it did not say), the
+    chunk size, the number of chunks and a running checksum, followed by
+    the received-chunk bitmap. Marking a chunk rewrites one bitmap byte and
+    the checksum, so the journal survives a reset mid transfer.
+    """
+
+    header_format = '>IIIHHI'
+    header_len = 20
+
+    def __init__(self, f, file_id, size, crc, chunk_size, num_packets, checksum, received):
+        self.f = f
+        self.file_id = file_id
+        self.size = size
+        self.crc = crc
+        self.chunk_size = chunk_size
+        self.num_packets = num_packets
+        self.checksum = checksum
+        self.received = received
+
+    @classmethod
+    def create(cls, path, file_id, size, crc, chunk_size, num_packets):
+        """Start a new journal, replacing any existing one at path
+        """
+        f = open(path, 'wb+')
+        journal = cls(f, file_id, size, crc, chunk_size, num_packets, 0,
+                      bytearray((num_packets + 7) // 8))
+        f.write(struct.pack(cls.header_format, file_id, size, crc, chunk_size, num_packets, 0))
+        f.write(journal.received)
+        f.flush()
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """Open an existing journal, returns None if there is none or it is damaged
+        """
+        try:
+            f = open(path, 'rb+')
+        except OSError:
+            return None
+        header = f.read(cls.header_len)
+        if len(header) != cls.header_len:
+            f.close()
+            return None
+        file_id, size, crc, chunk_size, num_packets, checksum = struct.unpack(cls.header_format, header)
+        received = bytearray(f.read())
+        if len(received) != (num_packets + 7) // 8:
+            f.close()
+            return None
+        return cls(f, file_id, size, crc, chunk_size, num_packets, checksum, received)
+
+    def has(self, seq):
+        return seq < self.num_packets and bool(self.received[seq >> 3] & (1 << (seq & 7)))
+
+    def missing(self):
+        return {i for i in range(self.num_packets) if not self.has(i)}
+
+    def mark(self, seq, chunk):
+        """Record that chunk `seq` has been written to the destination
+        """
+        if self.has(seq):
+            return
+        self.received[seq >> 3] |= 1 << (seq & 7)
+        self.checksum ^= self.chunk_checksum(seq, chunk)
+        self.f.seek(16)
+        self.f.write(struct.pack('>I', self.checksum))
+        self.f.seek(self.header_len + (seq >> 3))
+        self.f.write(self.received[seq >> 3:(seq >> 3) + 1])
+        self.f.flush()
+
+    @staticmethod
+    def chunk_checksum(seq, chunk):
+        # seeded with the sequence number and combined with xor, so the
+        # running checksum does not depend on the order chunks arrive in
+        return binascii.crc32(chunk, seq) & 0xFFFFFFFF
+
+    def close(self):
+        self.f.close()
+
 
 class FileTransferProtocol:
 
@@ -21,111 +119,738 @@ class FileTransferProtocol:
         self.log = log
         self.request_file_cmd = 's'
         self.request_partial_file_cmd = 'e'
-        self.chunk_size = 245
+        self.request_file_windowed_cmd = 'w'
+        self.request_file_info_cmd = 'i'
+        # chunks go out as raw ptp packets, so a chunk fills the whole
+        # ptp payload (max_data_len) with no msgpack bin header
+        self.chunk_size = 249
+        # selective-repeat settings, see send_file_windowed; each window
+        # costs a poll and a status, so a short one loses to send_file
+        self.window = 32
+        self.status_seq = 2**14 - 2
+        self.status_retries = 5
+        # most chunk numbers that fit in one request_partial_file_cmd
+        self.partial_request_len = 48
+        # a file is sent compressed only if its first sample_size bytes
+        # shrink below min_ratio of their size
+        self.compress_sample_size = 2048
+        self.compress_min_ratio = 0.9
+        # the one compressed copy kept on flash, see _compressed_path
+        self.scratch_path = '.ftp_scratch'
+        self._scratch = None
 
-    async def request_file(self, remote_path, local_path, retries=3):
-        if self.log: print("PyCubed requesting file now")
+    async def request_file_windowed(self, remote_path, local_path, window=None):
+        """Request a file using the selective-repeat transfer mode
+
+        Args:
+            remote_path (str): path to the file on the sender
+            local_path (str): where the file will be written
+            window (int, optional): chunks in flight per round. Defaults to self.window.
+
+        Returns:
+            bool: True if every chunk was received
+        """
+        if self.log: print("PyCubed requesting windowed file now")
         await self.ptp.send_packet(
             self.ptp.cmd_packet,
-            [self.request_file_cmd, remote_path],
+            [self.request_file_windowed_cmd, remote_path, window or self.window],
         )
-        missing = await self.receive_file(local_path)
-       
+        missing = await self.receive_file_windowed(local_path, self._file_id(remote_path), window)
+        return missing == set()
+
+    async def request_file(self, remote_path, local_path, retries=3, fec=None, compress=True):
+        """Request a file, resuming from its journal if an earlier request was cut short
+
+        Args:
+            remote_path (str): path to the file on the sender
+            local_path (str): where the file will be written
+            retries (int, optional): partial requests without progress before giving up. Defaults to 3.
+            fec (int, optional): ask for one repair chunk per fec chunks, see send_file. Defaults to None.
+            compress (bool, optional): advertise the codecs this end can decode. Defaults to True.
+
+        Returns:
+            bool: True if every chunk was received
+        """
+        file_id = self._file_id(remote_path)
+        data_path, codec = self._partial_path(local_path)
+        journal = None
+        if self._exists(self._journal_path(data_path)):
+            # only resume if the sender still has the same file
+            info = await self._request_info(remote_path, codec)
+            if info is None:
+                if self.log: print("sender did not describe the file, not resuming")
+                return False
+            if len(info) == 4:
+                journal = self._resume_journal(data_path, file_id, *info)
+            if journal is None:
+                if self.log: print("file changed on the sender, starting over")
+                self._drop_partial(data_path, codec)
+                data_path, codec = local_path, None
+        if journal is not None:
+            missing = journal.missing()
+            journal.close()
+            if self.log: print(f"resuming, {len(missing)} chunks missing")
+        else:
+            if self.log: print("PyCubed requesting file now")
+            request = [self.request_file_cmd, remote_path]
+            if fec or compress:
+                request.append(fec or 0)
+            if compress:
+                request.append(self.decoders())
+            while True:
+                await self.ptp.send_packet(self.ptp.cmd_packet, request)
+                missing = await self.receive_file(local_path, file_id)
+                if missing is not None:
+                    break
+                retries -= 1
+                if not retries:
+                    return False
+                # let the chunks sent after the lost header go by before asking again
+                await self._drain()
+            # a compressed file that is still incomplete waits next to local_path
+            data_path, codec = self._partial_path(local_path)
+
         while retries:
             if self.log: print(f"missing: {missing}")
             if self.log: print(f"retries remaining: {retries}")
             if missing == set():
+                if codec is not None:
+                    self._decode_file(data_path, local_path, codec)
                 return True
-            self.ptp.send_packet(
-                self.ptp.cmd_packet,
-                [self.request_partial_file_cmd, remote_path, list(missing)]
-            )
-            missing = await self.receive_partial_file(local_path, missing)
-            retries -= 1
+            requested = sorted(missing)[:self.partial_request_len]
+            request = [self.request_partial_file_cmd, remote_path, requested]
+            if codec is not None:
+                request.append(codec)
+            await self.ptp.send_packet(self.ptp.cmd_packet, request)
+            remaining = len(missing)
+            missing = await self.receive_partial_file(data_path, missing, requested)
+            if len(missing) == remaining:
+                retries -= 1
         return False
 
-    async def receive_file(self, local_path):
-        num_packets, sequence_number = await self.ptp.receive_packet()
-        num_packets = abs(num_packets)
+    async def receive_file(self, local_path, file_id=0):
+        """Receive a file sent with send_file
+
+        If the header announces repair chunks, a group that lost a single
+        chunk is rebuilt as soon as its repair chunk arrives. If it names a
+        codec, the compressed chunks are kept in local_path + '.' + codec
+        and decoded into local_path as far as they have arrived in order.
+
+        Args:
+            local_path (str): where the file will be written
+            file_id (int, optional): id of the remote file, see _file_id. Defaults to 0.
+
+        Returns:
+            set: sequence numbers that were never received, None if the
+            header was lost, in which case nothing on disk was touched
+        """
+        header, sequence_number = await self.ptp.receive_packet()
+        parity = None
+        codec = None
+        crc = 0
+        if isinstance(header, list) and len(header) >= 3:
+            num_packets, filesize, k = header[:3]
+            if k:
+                parity = XorParity(k, self.chunk_size, num_packets)
+            if len(header) > 3:
+                codec = header[3]
+            if len(header) > 4:
+                crc = header[4]
+        elif isinstance(header, int) and not isinstance(header, bool):
+            num_packets = abs(header)
+            filesize = 0
+        else:
+            # a timeout (False) or a chunk, the header never arrived
+            if self.log: print("file header lost")
+            return None
+        total = num_packets + (parity.num_groups if parity is not None else 0)
+        data_path = local_path if codec is None else f"{local_path}.{codec}"
         if self.log: print(f"expecting to receive {num_packets} packets")
-        with open(local_path, 'ab+') as f:
+        journal = TransferJournal.create(
+            self._journal_path(data_path), file_id, filesize, crc, self.chunk_size, num_packets
+        )
+        decoded = 0
+        out = None
+        if codec is not None:
+            decoder = self._decompressor(codec)
+            out = open(local_path, 'wb')
+        with self._open_presized(data_path, num_packets, self.chunk_size) as f:
             missing = {i for i in range(num_packets)}
-            for packet_num in range(num_packets):
+            for packet_num in range(total):
                 chunk, packet_num_recvc  = await self.ptp.receive_packet()
-                missing.remove(packet_num_recvc)
-                f.write(chunk)
-                os.sync()
-            return missing
-    
+                if chunk is False:
+                    continue
+                if parity is not None and packet_num_recvc >= num_packets:
+                    group = parity.repair_group(packet_num_recvc)
+                    if group is not None:
+                        self._repair(f, journal, parity, group, chunk, missing, filesize)
+                elif packet_num_recvc in missing:
+                    missing.remove(packet_num_recvc)
+                    self._write_chunk(f, packet_num_recvc, chunk, self.chunk_size)
+                    os.sync()
+                    journal.mark(packet_num_recvc, chunk)
+                if out is not None:
+                    # decode whatever is now contiguous from the start
+                    while decoded < num_packets and decoded not in missing:
+                        f.seek(decoded * self.chunk_size)
+                        out.write(decoder.decompress(f.read(self.chunk_size)))
+                        decoded += 1
+        if out is not None:
+            if not missing:
+                out.write(decoder.flush())
+            out.close()
+        self._finish_journal(journal, data_path)
+        if codec is not None and not missing:
+            os.remove(data_path)
+        return missing
+
+    def _repair(self, f, journal, parity, group, repair, missing, filesize):
+        """Rebuild the chunk a group lost, if it lost exactly one
+        """
+        lost = [seq for seq in parity.members(group) if seq in missing]
+        if len(lost) != 1:
+            return
+        seq = lost[0]
+        others = []
+        for other in parity.members(group):
+            if other != seq:
+                f.seek(other * self.chunk_size)
+                others.append(f.read(self.chunk_size))
+        length = min(self.chunk_size, filesize - seq * self.chunk_size)
+        chunk = parity.rebuild(repair, others, length)
+        if self.log: print(f"rebuilt chunk {seq}")
+        missing.remove(seq)
+        self._write_chunk(f, seq, chunk, self.chunk_size)
+        os.sync()
+        journal.mark(seq, chunk)
+
     async def receive_file_sync(self, local_path):
         num_packets, sequence_number = self.ptp.receive_packet_sync()
         num_packets = abs(num_packets)
         if self.log: print(f"expecting to receive {num_packets} packets")
-        with open(local_path, 'ab+') as f:
+        with self._open_presized(local_path, num_packets, self.chunk_size) as f:
             missing = {i for i in range(num_packets)}
             for packet_num in range(num_packets):
                 chunk, packet_num_recvc  = self.ptp.receive_packet_sync()
+                if packet_num_recvc not in missing:
+                    continue
                 missing.remove(packet_num_recvc)
-                f.write(chunk)
+                self._write_chunk(f, packet_num_recvc, chunk, self.chunk_size)
                 os.sync()
             return missing
 
-    async def receive_partial_file(self, local_path, missing):
+    async def receive_file_windowed(self, local_path, file_id=0, window=None):
+        """Receive a file sent with send_file_windowed
+
+        Chunks are written at their offset as they arrive, in any order.
+        Every poll from the sender is answered with a status frame so the
+        sender only repeats the holes. Once every chunk is in, the next
+        status frame is the last and nothing more is sent unless the sender
+        polls again because it missed it. If the journal for local_path
+        matches the header the transfer resumes from it, and the first
+        status frame tells the sender which chunks to skip.
+
+        Args:
+            local_path (str): where the file will be written
+            file_id (int, optional): id of the remote file, see _file_id. Defaults to 0.
+            window (int, optional): the sender's window, sizes the status bitmap. Defaults to self.window.
+
+        Returns:
+            set: sequence numbers that were never received, None if no header arrived
+        """
+        header = await self._receive_header()
+        if header is None:
+            return None
+        num_packets, filesize, chunk_size = header[:3]
+        crc = header[3] if len(header) > 3 else 0
+        if self.log: print(f"expecting to receive {num_packets} packets")
+        journal = self._resume_journal(local_path, file_id, num_packets, filesize, chunk_size, crc)
+        if journal is not None:
+            f = open(local_path, 'rb+')
+        else:
+            journal = TransferJournal.create(
+                self._journal_path(local_path), file_id, filesize, crc, chunk_size, num_packets
+            )
+            f = self._open_presized(local_path, num_packets, chunk_size)
+        received = journal.received
+        window = window or self.window
+        base = 0
+        while base < num_packets and self._has_chunk(received, base):
+            base += 1
+        quiet = 0
+        start = time.monotonic()
+        # the header arrives as the sender's first poll
+        await self._send_status(received, base, num_packets, window)
+        with f:
+            while quiet < self.status_retries:
+                chunk, seq = await self.ptp.receive_packet()
+                while base < num_packets and self._has_chunk(received, base):
+                    base += 1
+                if chunk is False:
+                    # only polls are answered, a status sent on a timeout
+                    # would collide with the sender's own retried poll
+                    quiet += 1
+                    continue
+                quiet = 0
+                if seq == self.status_seq:
+                    # once every chunk is in this is the final status, the
+                    # loop keeps listening in case the sender missed it
+                    await self._send_status(received, base, num_packets, window)
+                elif seq < num_packets and not self._has_chunk(received, seq):
+                    self._write_chunk(f, seq, chunk, chunk_size)
+                    os.sync()
+                    journal.mark(seq, chunk)
+        if self.log:
+            elapsed = time.monotonic() - start
+            print(f"goodput: {filesize / elapsed if elapsed else 0} B/s")
+            stats = self.link_stats()
+            if stats is not None: print(f"link: {stats.summary()}")
+        missing = journal.missing()
+        self._finish_journal(journal, local_path)
+        return missing
+
+    async def receive_partial_file(self, local_path, missing, requested=None):
         _, _ = await self.ptp.receive_packet()
-        missing_immutable = tuple(missing)
-        for expected_packet_num in missing_immutable:
-            chunk, recv_packet_num  = await self.ptp.receive_packet()
-            missing.remove(int(recv_packet_num))
-            location = self.packet_size * recv_packet_num
-            self.insert_into_file(chunk, local_path, location)
-            os.sync()
+        missing_immutable = tuple(missing if requested is None else requested)
+        journal = TransferJournal.load(self._journal_path(local_path))
+        with open(local_path, 'rb+') as f:
+            for expected_packet_num in missing_immutable:
+                chunk, recv_packet_num  = await self.ptp.receive_packet()
+                if chunk is False or recv_packet_num not in missing:
+                    continue
+                missing.remove(int(recv_packet_num))
+                self._write_chunk(f, recv_packet_num, chunk, self.chunk_size)
+                os.sync()
+                if journal is not None:
+                    journal.mark(recv_packet_num, chunk)
+        if journal is not None:
+            self._finish_journal(journal, local_path)
         return missing
 
-    def insert_into_file(self, data, filename, location):
-        """Insert data into a file, and be worried about running out of RAM
-        """
-        with open(filename, 'rb+') as fh:
-            fh.seek(location)
-            with open('tmpfile', 'wb+') as th:
-                for chunk, _ in self._read_chunks(fh, self.chunk_size): 
-                    print(chunk)
-                    th.write(chunk)
-                fh.seek(location)
-                fh.write(data)
-        
-        with open(filename, 'ab+') as fh:
-            fh.seek(location + len(data))
-            with open('tmpfile', 'rb+') as th:
-                for chunk, _ in self._read_chunks(th, self.chunk_size): 
-                    print(chunk)
-                    fh.write(chunk)
-        os.remove('tmpfile')
-
-    async def send_file(self, filename):
+    async def _drain(self):
+        """Discard packets until the link goes quiet
+        """
+        while True:
+            packet, _ = await self.ptp.receive_packet()
+            if packet is False:
+                return
+
+    def decoders(self):
+        """Codecs this end can decompress as a stream, most preferred first
+        """
+        codecs = []
+        if zlib is not None and hasattr(zlib, 'decompressobj'):
+            codecs.append('zlib')
+        codecs.append('lzss')
+        return codecs
+
+    def encoders(self):
+        """Codecs this end can compress with
+        """
+        codecs = []
+        if zlib is not None and hasattr(zlib, 'compressobj'):
+            codecs.append('zlib')
+        codecs.append('lzss')
+        return codecs
+
+    def _decompressor(self, codec):
+        if codec == 'zlib':
+            return zlib.decompressobj()
+        if codec == 'lzss':
+            return lzss.Decompressor()
+        raise ValueError(f"unknown codec {codec}")
+
+    def _compressor(self, codec):
+        if codec == 'zlib':
+            return zlib.compressobj()
+        if codec == 'lzss':
+            return lzss.Compressor()
+        raise ValueError(f"unknown codec {codec}")
+
+    def _choose_codec(self, filename, codecs):
+        """First of the receiver's codecs we can encode, if the file compresses
+
+        Returns:
+            str: codec name, or None to send the file as it is
+        """
+        if not codecs or filename.lower().endswith(INCOMPRESSIBLE):
+            return None
+        for codec in codecs:
+            if codec in self.encoders():
+                break
+        else:
+            return None
+        with open(filename, 'rb') as f:
+            sample = f.read(self.compress_sample_size)
+        if not sample:
+            return None
+        compressor = self._compressor(codec)
+        size = len(compressor.compress(sample)) + len(compressor.flush())
+        if size > len(sample) * self.compress_min_ratio:
+            return None
+        return codec
+
+    def _compressed_path(self, filename, codec):
+        """Compress filename into scratch_path, unless it already holds it
+
+        Only the last compressed file is kept, and it is made again only
+        when the source or codec changes. Both codecs are deterministic, so
+        chunks of a copy made again after a reset for a
+        request_partial_file_cmd line up with the ones sent before.
+        """
+        stats = os.stat(filename)
+        key = (filename, codec, stats[6], stats[8])
+        if self._scratch == key and self._exists(self.scratch_path):
+            return self.scratch_path
+        self._scratch = None
+        compressor = self._compressor(codec)
+        with open(filename, 'rb') as src, open(self.scratch_path, 'wb') as dst:
+            while True:
+                block = src.read(1024)
+                if not block:
+                    break
+                dst.write(compressor.compress(block))
+            dst.write(compressor.flush())
+        self._scratch = key
+        return self.scratch_path
+
+    def _decode_file(self, data_path, local_path, codec):
+        """Decompress a completely received file into local_path
+        """
+        decoder = self._decompressor(codec)
+        with open(data_path, 'rb') as src, open(local_path, 'wb') as dst:
+            while True:
+                block = src.read(self.chunk_size)
+                if not block:
+                    break
+                dst.write(decoder.decompress(block))
+            dst.write(decoder.flush())
+        os.remove(data_path)
+
+    def _partial_path(self, local_path):
+        """Where an unfinished transfer for local_path keeps its chunks
+
+        Returns:
+            (str, str): data path and codec, codec is None when uncompressed
+        """
+        for codec in ('zlib', 'lzss'):
+            path = f"{local_path}.{codec}"
+            if self._exists(self._journal_path(path)):
+                return path, codec
+        return local_path, None
+
+    def _exists(self, path):
+        try:
+            os.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def link_stats(self):
+        """The radio's LinkStats when ptp runs over an RFM9x PacketStream, else None
+        """
+        radio = getattr(getattr(self.ptp, 'protocol', None), 'radio', None)
+        return getattr(radio, 'stats', None)
+
+    def _file_id(self, remote_path):
+        return binascii.crc32(remote_path.encode()) & 0xFFFFFFFF
+
+    def _journal_path(self, local_path):
+        return local_path + '.jnl'
+
+    def _resume_journal(self, local_path, file_id, num_packets, size, chunk_size, crc):
+        """Load the journal for local_path if it belongs to this transfer
+
+        The sender's description of the file ([num_packets, filesize,
+        chunk_size, crc32], see _file_info) must match the journal, and the
+        chunks the journal lists are checked against its running checksum
+        so a destination file that was changed since is not trusted.
+
+        Returns:
+            TransferJournal: the journal to resume from, or None to start over
+        """
+        journal = TransferJournal.load(self._journal_path(local_path))
+        if journal is None:
+            return None
+        if (journal.file_id != file_id
+                or journal.num_packets != num_packets
+                or journal.size != size
+                or journal.chunk_size != chunk_size
+                or journal.crc != crc
+                or not self._verify_journal(journal, local_path)):
+            journal.close()
+            return None
+        return journal
+
+    def _drop_partial(self, data_path, codec):
+        """Forget an unfinished transfer, its journal and any compressed chunks
+        """
+        for path in (self._journal_path(data_path), data_path if codec is not None else None):
+            if path is not None and self._exists(path):
+                os.remove(path)
+
+    async def _request_info(self, remote_path, codec):
+        """Ask the sender to describe a file, see send_file_info
+
+        Returns:
+            list: [num_packets, filesize, chunk_size, crc32], empty if the
+            sender does not have the file, None if it never answered
+        """
+        for _ in range(self.status_retries):
+            await self.ptp.send_packet(
+                self.ptp.cmd_packet,
+                [self.request_file_info_cmd, remote_path, codec]
+            )
+            info, _ = await self.ptp.receive_packet()
+            if isinstance(info, list):
+                return info
+        return None
+
+    def _file_info(self, filename):
+        """[num_packets, filesize, chunk_size, crc32] of a file as it is sent
+        """
+        crc = 0
+        size = 0
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(1024)
+                if not block:
+                    break
+                crc = binascii.crc32(block, crc)
+                size += len(block)
+        return [math.ceil(size / self.chunk_size), size, self.chunk_size, crc & 0xFFFFFFFF]
+
+    def _verify_journal(self, journal, local_path):
+        checksum = 0
+        try:
+            with open(local_path, 'rb') as f:
+                for seq in range(journal.num_packets):
+                    if journal.has(seq):
+                        f.seek(seq * journal.chunk_size)
+                        checksum ^= journal.chunk_checksum(seq, f.read(journal.chunk_size))
+        except OSError:
+            return False
+        return checksum == journal.checksum
+
+    def _finish_journal(self, journal, local_path):
+        """Close the journal, removing it once every chunk has arrived
+        """
+        journal.close()
+        if not journal.missing():
+            os.remove(self._journal_path(local_path))
+
+    def _open_presized(self, local_path, num_packets, chunk_size):
+        """Create the destination file with room for every chunk
+
+        Every chunk but the last is exactly chunk_size, so the file is
+        allocated up to the start of the last chunk. Writing the last chunk
+        then leaves the file at its true size without needing truncate(),
+        which CircuitPython files do not have.
+
+        Args:
+            local_path (str): where the file will be written
+            num_packets (int): number of chunks in the file
+            chunk_size (int): size of every chunk but the last
+
+        Returns:
+            file: the destination opened for random access writes
+        """
+        f = open(local_path, 'wb+')
+        size = (num_packets - 1) * chunk_size
+        if size > 0:
+            # FatFs extends the file on a seek past the end, the byte written
+            # here is overwritten by its chunk later
+            f.seek(size - 1)
+            f.write(b'\x00')
+        return f
+
+    def _write_chunk(self, f, seq, chunk, chunk_size):
+        """Place a chunk at its offset with a single seek and write
+        """
+        f.seek(seq * chunk_size)
+        f.write(chunk)
+
+    async def send_file(self, filename, fec=None, codecs=None):
         """Send a file
 
         Args:
             filename (str): path to file that will be sent
-            chunk_size (int, optional): chunk sizes that will be sent. Defaults to 64.
+            fec (int, optional): send an XOR repair chunk after every fec
+                chunks so the receiver can rebuild one lost chunk per group
+                without a retransmit round. Defaults to None (no repair chunks).
+            codecs (list, optional): codecs the receiver can decode, in its
+                order of preference. The file is sent compressed with the
+                first one this end supports, unless it does not compress.
+                Defaults to None (send as is).
         """
+        codec = self._choose_codec(filename, codecs)
+        if codec is not None:
+            filename = self._compressed_path(filename, codec)
+        num_packets, filesize, _, crc = self._file_info(filename)
         with open(filename, 'rb') as f:
-            stats = os.stat(filename)
-            filesize = stats[6]
-            
-            # send the number of packets for the client
+            # send the number of packets for the client, the size and crc
+            # let it check a later resume against the file
             print("sending number of packets!!!!!")
+            parity = XorParity(fec, self.chunk_size, num_packets) if fec else None
             await self.ptp.send_packet(
                 self.ptp.data_packet,
-                 - math.ceil(filesize / self.chunk_size)
+                [num_packets, filesize, fec or 0, codec, crc]
             )
 
             # send all the chunks
             for chunk, packet_num in self._read_chunks(f, self.chunk_size):
                 await self.ptp.send_packet(
-                    self.ptp.data_packet,
+                    self.ptp.raw_packet,
                     chunk,
                     packet_num
                 )
+                if parity is not None:
+                    parity.add(chunk)
+                    if packet_num % fec == fec - 1 or packet_num == num_packets - 1:
+                        await self.ptp.send_packet(
+                            self.ptp.raw_packet,
+                            parity.take(),
+                            parity.repair_seq(parity.group(packet_num))
+                        )
+
+    async def send_file_windowed(self, filename, window=None):
+        """Send a file using selective repeat
+
+        Up to `window` chunks that have not been acknowledged are sent per
+        round, then the receiver is polled for a status frame: the index of
+        its first missing chunk followed by a bitmap of the chunks after it.
+        Only the holes are sent again, so a lost chunk costs one chunk of
+        airtime instead of a full request_partial_file_cmd round trip.
+
+        Args:
+            filename (str): path to file that will be sent
+            window (int, optional): chunks in flight per round. Defaults to self.window.
+
+        Returns:
+            bool: True once the receiver has acknowledged every chunk
+        """
+        window = window or self.window
+        header = self._file_info(filename)
+        num_packets = header[0]
+        acked = bytearray((num_packets + 7) // 8)
+        with open(filename, 'rb') as f:
+            # the first poll carries the header, the answer says what the
+            # receiver already holds from an earlier pass
+            status = await self._poll_status(header)
+            while status is not None:
+                base = self._merge_status(acked, status, num_packets)
+                if self.log: print(f"acknowledged up to {base}/{num_packets}")
+                if base >= num_packets:
+                    return True
+                seq = base
+                in_flight = 0
+                while in_flight < window and seq < num_packets:
+                    if not self._has_chunk(acked, seq):
+                        f.seek(seq * self.chunk_size)
+                        await self.ptp.send_packet(
+                            self.ptp.raw_packet,
+                            f.read(self.chunk_size),
+                            seq
+                        )
+                        in_flight += 1
+                    seq += 1
+                status = await self._poll_status(header)
+        if self.log: print("receiver stopped answering")
+        return False
+
+    async def send_file_info(self, filename, codec=None):
+        """Describe a file, the answer to request_file_info_cmd
+
+        Sends [num_packets, filesize, chunk_size, crc32] of the file as
+        send_file would send it with codec, or [] if there is no such file,
+        so a receiver can check its journal before resuming.
+        """
+        try:
+            if codec is not None:
+                filename = self._compressed_path(filename, codec)
+            info = self._file_info(filename)
+        except OSError:
+            info = []
+        await self.ptp.send_packet(self.ptp.data_packet, info)
+
+    async def send_partial_file(self, filename, missing, codec=None):
+        """Send only the listed chunks of a file, the answer to request_partial_file_cmd
+
+        Args:
+            filename (str): path to file that will be sent
+            missing (list): sequence numbers of the chunks to send
+            codec (str, optional): the file went out compressed with this codec. Defaults to None.
+        """
+        if codec is not None:
+            filename = self._compressed_path(filename, codec)
+        with open(filename, 'rb') as f:
+            await self.ptp.send_packet(self.ptp.data_packet, -len(missing))
+            for packet_num in missing:
+                f.seek(packet_num * self.chunk_size)
+                await self.ptp.send_packet(
+                    self.ptp.raw_packet,
+                    f.read(self.chunk_size),
+                    packet_num
+                )
+
+    async def _receive_header(self):
+        """Wait for the file header, which every poll carries in case one is lost
+        """
+        quiet = 0
+        while quiet < self.status_retries:
+            header, seq = await self.ptp.receive_packet()
+            if seq == self.status_seq and isinstance(header, list):
+                return header
+            if header is False:
+                quiet += 1
+        return None
+
+    async def _poll_status(self, header):
+        """Ask the receiver for a status frame, retrying if it is lost
+        """
+        for _ in range(self.status_retries):
+            await self.ptp.send_packet(self.ptp.data_packet, header, self.status_seq)
+            status, seq = await self.ptp.receive_packet()
+            if seq == self.status_seq and isinstance(status, list):
+                return status
+        return None
+
+    async def _send_status(self, received, base, num_packets, window):
+        """Report the first missing chunk and a bitmap of the chunks after it
+
+        The bitmap covers at most two windows past base, all the sender can
+        have in flight beyond the first hole, and never past the last chunk.
+        """
+        bits = max(0, min(num_packets - base, 2 * window))
+        bitmap = bytearray((bits + 7) // 8)
+        for i in range(bits):
+            if self._has_chunk(received, base + i):
+                bitmap[i >> 3] |= 1 << (i & 7)
+        await self.ptp.send_packet(
+            self.ptp.data_packet,
+            [base, bytes(bitmap)],
+            self.status_seq
+        )
+
+    def _merge_status(self, acked, status, num_packets):
+        """Mark every chunk the receiver reported, returns the first unacked chunk
+        """
+        base, bitmap = status
+        for seq in range(min(base, num_packets)):
+            acked[seq >> 3] |= 1 << (seq & 7)
+        for i in range(len(bitmap) * 8):
+            if bitmap[i >> 3] & (1 << (i & 7)) and base + i < num_packets:
+                acked[(base + i) >> 3] |= 1 << ((base + i) & 7)
+        while base < num_packets and self._has_chunk(acked, base):
+            base += 1
+        return base
+
+    def _has_chunk(self, bitmap, seq):
+        """True if bit `seq` is set, bits past the end of the bitmap read as unset
+        """
+        if (seq >> 3) >= len(bitmap):
+            return False
+        return bool(bitmap[seq >> 3] & (1 << (seq & 7)))
 
     def send_file_sync(self, filename):
         """Send a file
@@ -146,7 +871,7 @@ class FileTransferProtocol:
 
             # send all the chunks
             for chunk, packet_num in self._read_chunks(f, self.chunk_size):
-                self.ptp.send_data_packet_sync(
+                self.ptp.send_raw_packet_sync(
                     chunk,
                     packet_num
                 )
@@ -0,0 +1,163 @@
+"""
+`lzss`
+====================================================
+
+Small streaming LZSS codec for CircuitPython
+
+Implementation Notes
+--------------------
+Output is a run of groups: a flag byte, then up to 8 items. A set flag bit
+is a literal byte, a clear bit is a 2 byte back reference, 12 bits of
+distance - 1 and 4 bits of length - 3, into the last 4096 bytes of output.
+The decompressor needs a 4 KiB history ring and a few bytes of state, the
+compressor a fixed table of the last position of each 12 bit hash of a 3
+byte prefix, and both sides accept input in pieces of any size.
+
+"""
+
+import array
+
+WINDOW = 4096
+MIN_MATCH = 3
+MAX_MATCH = 18
+HASH_BITS = 12
+
+
+class Compressor:
+    """Streaming LZSS compressor, compress() pieces then flush() once"""
+
+    def __init__(self):
+        self.buf = bytearray()
+        # absolute position of buf[0] and index in buf of the next byte to encode
+        self.base = 0
+        self.pos = 0
+        # last absolute position + 1 a 3 byte prefix hash was seen at, 0 for never
+        self.table = array.array('I', bytes(4 << HASH_BITS))
+        self.out = bytearray()
+        self.flag_index = 0
+        self.flag_bit = 8
+
+    def compress(self, data):
+        self.buf.extend(data)
+        self._encode(False)
+        return self._take()
+
+    def flush(self):
+        self._encode(True)
+        return self._take()
+
+    def _take(self):
+        if self.flag_bit < 8:
+            # the open group stays behind until it is full
+            done = bytes(self.out[:self.flag_index])
+            self.out = self.out[self.flag_index:]
+            self.flag_index = 0
+        else:
+            done = bytes(self.out)
+            self.out = bytearray()
+        return done
+
+    def _item(self, literal):
+        if self.flag_bit == 8:
+            self.flag_index = len(self.out)
+            self.out.append(0)
+            self.flag_bit = 0
+        if literal:
+            self.out[self.flag_index] |= 1 << self.flag_bit
+        self.flag_bit += 1
+
+    def _encode(self, final):
+        buf = self.buf
+        table = self.table
+        # keep a full match of lookahead until the last piece
+        end = len(buf) if final else len(buf) - MAX_MATCH
+        pos = self.pos
+        while pos < end:
+            length = 0
+            if pos + MIN_MATCH <= len(buf):
+                key = _hash(buf, pos)
+                here = self.base + pos
+                cand = table[key] - 1
+                table[key] = here + 1
+                # a hash hit may be another prefix, the compare below checks
+                if cand >= 0 and here - cand <= WINDOW:
+                    c = cand - self.base
+                    limit = min(MAX_MATCH, len(buf) - pos)
+                    while length < limit and buf[c + length] == buf[pos + length]:
+                        length += 1
+            if length >= MIN_MATCH:
+                distance = self.base + pos - cand - 1
+                self._item(False)
+                self.out.append(distance >> 4)
+                self.out.append(((distance & 0x0F) << 4) | (length - MIN_MATCH))
+                for i in range(pos + 1, pos + length):
+                    if i + MIN_MATCH <= len(buf):
+                        table[_hash(buf, i)] = self.base + i + 1
+                pos += length
+            else:
+                self._item(True)
+                self.out.append(buf[pos])
+                pos += 1
+        if final:
+            self.flag_bit = 8
+        # drop history that has left the window
+        if pos > 2 * WINDOW:
+            drop = pos - WINDOW
+            self.buf = buf[drop:]
+            self.base += drop
+            pos -= drop
+        self.pos = pos
+
+
+def _hash(buf, i):
+    # the 3 bytes folded into HASH_BITS, small multipliers so no long ints are made
+    return ((buf[i] * 53) ^ (buf[i + 1] * 44) ^ (buf[i + 2] * 31)) & ((1 << HASH_BITS) - 1)
+
+
+class Decompressor:
+    """Streaming LZSS decompressor, feed it the compressed bytes in order"""
+
+    def __init__(self):
+        self.history = bytearray(WINDOW)
+        self.hpos = 0
+        self.pending = b""
+        self.flags = 0
+        self.flag_bit = 8
+
+    def decompress(self, data):
+        p = self.pending + bytes(data)
+        out = bytearray()
+        history = self.history
+        i = 0
+        while True:
+            if self.flag_bit == 8:
+                if i >= len(p):
+                    break
+                self.flags = p[i]
+                i += 1
+                self.flag_bit = 0
+            if self.flags >> self.flag_bit & 1:
+                if i >= len(p):
+                    break
+                b = p[i]
+                i += 1
+                out.append(b)
+                history[self.hpos] = b
+                self.hpos = (self.hpos + 1) & (WINDOW - 1)
+            else:
+                if i + 2 > len(p):
+                    break
+                distance = ((p[i] << 4) | (p[i + 1] >> 4)) + 1
+                length = (p[i + 1] & 0x0F) + MIN_MATCH
+                i += 2
+                for _ in range(length):
+                    b = history[(self.hpos - distance) & (WINDOW - 1)]
+                    out.append(b)
+                    history[self.hpos] = b
+                    self.hpos = (self.hpos + 1) & (WINDOW - 1)
+            self.flag_bit += 1
+        self.pending = p[i:]
+        return bytes(out)
+
+    def flush(self):
+        return b""
@@ -1,70 +1,118 @@
+import asyncio
 import binascii
 import io
+import time
 
 import msgpack
 
 
 class AsyncPacketTransferProtocol:
-    """A simple transfer protocol for commands and data"""
+    """A simple transfer protocol for commands and data
+
+    Every frame starts with a 3 byte header: packet type (2 bits), payload
+    length (8 bits) and sequence number (14 bits). Data and command payloads
+    are msgpack encoded, raw payloads are bytes sent verbatim. An aggregate
+    payload is a run of complete frames packed into one radio packet, see
+    queue_packet.
+    """
 
     def __init__(self, protocol, packet_size=252, log=False):
         self.protocol = protocol
         self.packet_size = 252
         self.log = log
-        self.tmp_stream = io.BytesIO()
-        self.out_stream = io.BytesIO()
         self.data_packet = 0
         self.cmd_packet = 1
+        self.raw_packet = 2
+        self.agg_packet = 3
         self.header_len = 3
+        # sequence numbers are 14 bits, the top one is the "no sequence" default
+        self.max_sequence_num = 2**14 - 1
         self.max_packet_total_size = 252
         self.max_data_len = self.max_packet_total_size - self.header_len
+        # Everything a packet needs is allocated here once and reused, so
+        # steady state encode/decode does not touch the heap (apart from the
+        # objects msgpack.unpack hands back). Pre-sized streams never grow.
+        self.tmp_stream = io.BytesIO(bytes(self.max_packet_total_size))
+        self.rx_stream = io.BytesIO(bytes(self.max_packet_total_size))
+        # outgoing frames are built here and handed to the radio as a view
+        self.frame = bytearray(self.max_packet_total_size)
+        self.frame_view = memoryview(self.frame)
+        self.payload_view = self.frame_view[self.header_len:]
+        # frame_view[:n] for each frame length, created the first time used
+        self.frame_views = [None] * (self.max_packet_total_size + 1)
+        # small messages queued for one aggregate frame, sent once agg_budget
+        # bytes are queued or the oldest has waited agg_deadline seconds
+        self.agg_budget = self.max_data_len
+        self.agg_deadline = 0.5
+        self.agg = bytearray(self.max_data_len)
+        self.agg_view = memoryview(self.agg)
+        self.agg_len = 0
+        self.agg_started = None
+        # (payload, sequence_num) split out of a received aggregate
+        self.pending = []
+
+    def frame_slice(self, n):
+        """Cached view of the first n bytes of the frame buffer."""
+        view = self.frame_views[n]
+        if view is None:
+            view = self.frame_views[n] = self.frame_view[:n]
+        return view
+
+    def write_packet_into_frame(self, packet_type, payload, sequence_num):
+        """Encode header and payload into self.frame.
+
+        Raw packets copy the payload bytes as they are, everything else is
+        msgpack encoded.
 
-    def write_packet_into_out_stream(self, packet_type, payload, sequence_num):
-        self.out_stream.seek(0)
-        self.tmp_stream.seek(0)
-        if packet_type != self.cmd_packet and packet_type != self.data_packet:
+        Returns:
+            the payload length, or -1 if the packet cannot be encoded.
+            The frame to send is frame_slice(header_len + payload_len).
+        """
+        if packet_type not in (self.cmd_packet, self.data_packet, self.raw_packet, self.agg_packet):
             return -1
-        elif sequence_num > 2**15 - 1:
+        elif sequence_num > self.max_sequence_num:
             return -1
+        elif packet_type == self.raw_packet or packet_type == self.agg_packet:
+            payload_len = len(payload)
+            if payload_len > self.max_data_len:
+                return -1
+            self.frame[self.header_len:self.header_len + payload_len] = payload
         else:
+            self.tmp_stream.seek(0)
             msgpack.pack(payload, self.tmp_stream)
             payload_len = self.tmp_stream.tell()
-            self.tmp_stream.seek(0)
             if payload_len > self.max_data_len:
                 return -1
-            header = (packet_type << 23) | (payload_len << 15) | sequence_num
-            if self.log:
-                print(f"header: {header}")
-            if self.log:
-                print(f"packet type: {packet_type}")
-            if self.log:
-                print(f"payload len: {payload_len}")
-            if self.log:
-                print(f"sequence num: {sequence_num}")
-            if self.log:
-                print(f"pycubed sending packet: {self.tmp_stream.getvalue()}")
-            header_arr = bytearray(3)
-            header_arr[0] = (header >> 2 * 8) & 0xFF
-            header_arr[1] = header >> 8 & 0xFF
-            header_arr[2] = header & 0xFF
-            self.out_stream.write(header_arr)
-            self.out_stream.write(self.tmp_stream.read(payload_len))
-            self.out_stream.seek(0)
-            self.tmp_stream = io.BytesIO()  # TODO fix this.
+            # bytes past payload_len are stale, they land in the frame buffer
+            # but are never sent
             self.tmp_stream.seek(0)
-            return payload_len
+            self.tmp_stream.readinto(self.payload_view)
+        header = (packet_type << 22) | (payload_len << 14) | sequence_num
+        if self.log:
+            print(f"header: {header}")
+        if self.log:
+            print(f"packet type: {packet_type}")
+        if self.log:
+            print(f"payload len: {payload_len}")
+        if self.log:
+            print(f"sequence num: {sequence_num}")
+        if self.log:
+            print(f"pycubed sending packet: {bytes(self.payload_view[:payload_len])}")
+        self.frame[0] = (header >> 2 * 8) & 0xFF
+        self.frame[1] = header >> 8 & 0xFF
+        self.frame[2] = header & 0xFF
+        return payload_len
 
     def send_cmd_packet_sync(self, command):
-        payload_len = self.write_packet_into_out_stream(
-            self.cmd_packet, command, 2**15-1
+        payload_len = self.write_packet_into_frame(
+            self.cmd_packet, command, self.max_sequence_num
         )
         if payload_len == -1:
             return False
-        self.out_stream.seek(0)
+        frame = self.frame_slice(self.header_len + payload_len)
         if self.log:
-            print(f"wrote data: {self.out_stream.read(252)}")
-        self.out_stream.seek(0)
-        success = self.protocol.send_with_ack(self.out_stream.read(252))
+            print(f"wrote data: {bytes(frame)}")
+        success = self.protocol.send_with_ack(frame)
         if self.log:
             print("waiting for ack...")
         if not success:
@@ -74,32 +122,38 @@ class AsyncPacketTransferProtocol:
         if self.log:
             print("received ack")
 
-    def send_data_packet_sync(self, payload, sequence_num=2**15 - 1):
-        payload_len = self.write_packet_into_out_stream(
-            self.data_packet, payload, sequence_num
+    def send_data_packet_sync(self, payload, sequence_num=2**14 - 1):
+        return self.send_packet_sync(self.data_packet, payload, sequence_num)
+
+    def send_raw_packet_sync(self, payload, sequence_num=2**14 - 1):
+        return self.send_packet_sync(self.raw_packet, payload, sequence_num)
+
+    def send_packet_sync(self, packet_type, payload, sequence_num=2**14 - 1):
+        payload_len = self.write_packet_into_frame(
+            packet_type, payload, sequence_num
         )
         if payload_len == -1:
             return False
-        self.out_stream.seek(0)
+        frame = self.frame_slice(self.header_len + payload_len)
         if self.log:
-            print(f"wrote data: {self.out_stream.read(252)}")
-        self.out_stream.seek(0)
-        self.protocol.send(self.out_stream.read(252))
-        self.out_stream.seek(0)
+            print(f"wrote data: {bytes(frame)}")
+        self.protocol.send(frame)
         return True
 
-    async def send_packet(self, packet_type, payload, sequence_num=2**15 - 1):
-        payload_len = self.write_packet_into_out_stream(
+    async def send_packet(self, packet_type, payload, sequence_num=2**14 - 1):
+        # anything already queued goes first so messages stay in order
+        if self.agg_len:
+            await self.flush()
+        payload_len = self.write_packet_into_frame(
             packet_type, payload, sequence_num
         )
         if payload_len == -1:
             return False
+        frame = self.frame_slice(self.header_len + payload_len)
+        if self.log:
+            print(f"wrote data: {bytes(frame)}")
         if packet_type == self.cmd_packet:
-            self.out_stream.seek(0)
-            if self.log:
-                print(f"wrote data: {self.out_stream.read(252)}")
-            self.out_stream.seek(0)
-            success = await self.protocol.send_with_ack(self.out_stream.read(252))
+            success = await self.protocol.send_with_ack(frame)
             if self.log:
                 print("waiting for ack...")
             if not success:
@@ -109,23 +163,73 @@ class AsyncPacketTransferProtocol:
             if self.log:
                 print("received ack")
         else:
-            self.out_stream.seek(0)
-            if self.log:
-                print(f"wrote data: {self.out_stream.read(252)}")
-            self.out_stream.seek(0)
-            self.protocol.send(self.out_stream.read(252))
-        self.out_stream.seek(0)
+            await self.protocol.asend(frame)
+        return True
+
+    async def queue_packet(self, packet_type, payload, sequence_num=2**14 - 1):
+        """Queue a small message to share a radio packet with others
+
+        The message is packed into the pending aggregate frame, which is sent
+        once it holds agg_budget bytes, when a message does not fit, when
+        send_packet is called, or agg_deadline seconds after the first message
+        was queued (see run_aggregator). Command packets sent this way are not
+        acknowledged. Messages too big to share a frame are sent on their own.
+
+        Returns:
+            bool: False if the message cannot be encoded
+        """
+        payload_len = self.write_packet_into_frame(packet_type, payload, sequence_num)
+        if payload_len == -1:
+            return False
+        n = self.header_len + payload_len
+        if n > self.agg_budget:
+            return await self.send_packet(packet_type, payload, sequence_num)
+        if self.agg_len + n > self.agg_budget:
+            # flushing reuses the frame buffer, encode the message again after
+            await self.flush()
+            self.write_packet_into_frame(packet_type, payload, sequence_num)
+        if not self.agg_len:
+            self.agg_started = time.monotonic()
+        self.agg[self.agg_len:self.agg_len + n] = self.frame_slice(n)
+        self.agg_len += n
+        if self.agg_budget - self.agg_len <= self.header_len:
+            await self.flush()
+        elif time.monotonic() - self.agg_started >= self.agg_deadline:
+            await self.flush()
         return True
 
+    async def flush(self):
+        """Send the queued messages as one aggregate frame"""
+        if not self.agg_len:
+            return True
+        n = self.agg_len
+        self.agg_len = 0
+        self.agg_started = None
+        payload_len = self.write_packet_into_frame(
+            self.agg_packet, self.agg_view[:n], self.max_sequence_num
+        )
+        if self.log:
+            print(f"sending aggregate of {payload_len} bytes")
+        await self.protocol.asend(self.frame_slice(self.header_len + payload_len))
+        return True
+
+    async def run_aggregator(self):
+        """Flush queued messages once they reach agg_deadline, run as a task"""
+        while True:
+            if self.agg_len and time.monotonic() - self.agg_started >= self.agg_deadline:
+                await self.flush()
+            await asyncio.sleep(self.agg_deadline / 4)
+
     async def receive_packet(self):
+        if self.pending:
+            return self.pending.pop(0)
         data = await self.protocol.read(3)
         if data is None:
             return False, False
-        header_arr = bytearray(data)
-        header = int.from_bytes(header_arr[0:3], "big")
-        packet_type = header >> 23
-        payload_len = (header >> 15) & (2**8 - 1)
-        sequence_num = header & (2**15 - 1)
+        header = int.from_bytes(data, "big")
+        packet_type = header >> 22
+        payload_len = (header >> 14) & (2**8 - 1)
+        sequence_num = header & (2**14 - 1)
         if self.log:
             print(f"header: {header}")
         if self.log:
@@ -134,42 +238,89 @@ class AsyncPacketTransferProtocol:
             print(f"payload len: {payload_len}")
         if self.log:
             print(f"sequence num: {sequence_num}")
-        self.tmp_stream = io.BytesIO()
-        if self.log:
-            print(f"tmp stream before rw: {self.tmp_stream.getvalue()}")
-        self.tmp_stream.seek(0)
+        if packet_type == self.raw_packet or packet_type == self.agg_packet:
+            # a view into the radio buffer, valid until the next receive
+            payload = await self.protocol.read(payload_len)
+            if payload is None:
+                if self.log:
+                    print("short packet")
+                return False, False
+            if packet_type == self.raw_packet:
+                return payload, sequence_num
+            self.split_aggregate(payload)
+            if not self.pending:
+                return False, False
+            return self.pending.pop(0)
+        self.rx_stream.seek(0)
         payload_pack_success = await self.protocol.read_into_stream(
-            payload_len, self.tmp_stream
+            payload_len, self.rx_stream
         )
+        if not payload_pack_success:
+            # the stream still holds an older packet, do not decode it
+            if self.log:
+                print("short packet")
+            return False, False
+        success, payload = self.unpack_rx_stream(payload_len)
+        if not success:
+            return False, False
+        if packet_type == self.cmd_packet:
+            print("pycubed sending ACK")
+            await self.protocol.asend(b"ACK")
         if self.log:
-            print(f"tmp stream before write: {self.tmp_stream.getvalue()}")
-        self.tmp_stream.seek(0)
+            print(f"payload: {payload}")
+        return payload, sequence_num
+
+    def split_aggregate(self, frames):
+        """Decode every frame packed in an aggregate payload onto self.pending
+
+        Raw payloads stay views into the radio buffer; receive_packet hands
+        out everything pending before it reads the radio again.
+        """
+        offset = 0
+        while offset + self.header_len <= len(frames):
+            header = int.from_bytes(frames[offset:offset + self.header_len], "big")
+            packet_type = header >> 22
+            payload_len = (header >> 14) & (2**8 - 1)
+            sequence_num = header & (2**14 - 1)
+            offset += self.header_len
+            if offset + payload_len > len(frames):
+                if self.log:
+                    print("truncated aggregate")
+                return
+            payload = frames[offset:offset + payload_len]
+            offset += payload_len
+            if packet_type == self.raw_packet:
+                self.pending.append((payload, sequence_num))
+            elif packet_type != self.agg_packet:
+                self.rx_stream.seek(0)
+                self.rx_stream.write(payload)
+                success, payload = self.unpack_rx_stream(payload_len)
+                if success:
+                    self.pending.append((payload, sequence_num))
+
+    def unpack_rx_stream(self, payload_len):
+        """Decode the msgpack payload at the start of rx_stream
+
+        Returns:
+            (bool, object): whether decoding worked, and the payload
+        """
         if self.log:
-            print(f"payload_packed: {self.tmp_stream.read(payload_len)}")
-        self.tmp_stream.seek(0)
+            print(f"payload_packed: {self.rx_stream.getvalue()[:payload_len]}")
+        # msgpack stops after one object so stale bytes past payload_len are
+        # never read
+        self.rx_stream.seek(0)
         try:
-            payload = msgpack.unpack(self.tmp_stream)  # TODO make this the same?
+            payload = msgpack.unpack(self.rx_stream)
         except TypeError:
-            print(f"Unexpected structure: {self.tmp_stream.getvalue()}")
-            return False, False
+            print(f"Unexpected structure: {self.rx_stream.getvalue()[:payload_len]}")
+            return False, None
         except ValueError:
-            print(f"Failed to decode: {self.tmp_stream.getvalue()}")
-            return False, False
+            print(f"Failed to decode: {self.rx_stream.getvalue()[:payload_len]}")
+            return False, None
         except Exception as e:
-            print(f"Unknown exception: {self.tmp_stream.getvalue()} {e}")
-            return False, False
-        else:
-            if packet_type == self.cmd_packet:
-                print("pycubed sending ACK")
-                self.protocol.send(b"ACK")
-            self.tmp_stream = io.BytesIO()
-            self.tmp_stream.seek(0)
-            if self.log:
-                print(f"payload: {payload}")
-            return payload, sequence_num
-        finally:
-            self.tmp_stream = io.BytesIO()
-            self.tmp_stream.seek(0)
+            print(f"Unknown exception: {self.rx_stream.getvalue()[:payload_len]} {e}")
+            return False, None
+        return True, payload
 
     def crc32(self, packet_type, payload):
         packet_bytes = b""
@@ -33,6 +33,8 @@ http: www.airspayce.com/mikem/arduino/RadioHead/
 """
 import time
 from random import random
+import asyncio
+import array
 import digitalio
 from micropython import const
 import adafruit_bus_device.spi_device as spidev
@@ -133,6 +135,16 @@ VR3X=b'\xff\x00\xff\x00\xff\x00\xff\x00\x00\x00\xff\xff\xff\x00\xff\x00\x00\x00\
 # the warning to work around the error.
 # pylint: disable=too-many-instance-attributes
 
+# Configuration registers that only change when this driver writes them.
+# With the register shadow on they are mirrored in RAM: reads never touch
+# SPI once known and writes of an unchanged value are skipped. Status, FIFO
+# and OP_MODE (the chip leaves TX/RX modes on its own) always go to SPI.
+_SHADOW_MASK = bytearray(16)
+for _reg in (0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0E, 0x0F,
+             0x1D, 0x1E, 0x20, 0x21, 0x22, 0x24, 0x26, 0x2F, 0x30,
+             0x31, 0x36, 0x37, 0x3A, 0x40, 0x4D):
+    _SHADOW_MASK[_reg >> 3] |= 1 << (_reg & 7)
+
 _bigbuffer=bytearray(256)
 bw_bins = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000)
 class RFM9x:
@@ -258,15 +270,40 @@ class RFM9x:
         code_rate=5,
         high_power=True,
         baudrate=5000000,
-        rfm95pw=False
+        rfm95pw=False,
+        shadow_registers=True
     ):
+        self.shadow_registers = shadow_registers
+        """Serve configuration register reads from a RAM copy, see resync()"""
+        self._shadow = bytearray(128)
+        self._shadow_valid = bytearray(16)
+        # upper OP_MODE bits (LoRa, modulation, LF), only changed by writes
+        self._op_high = None
+        # FIFO_RX_CURRENT_ADDR (0x10) through PKT_RSSI_VALUE (0x1A)
+        self._rx_status = bytearray(11)
+        # (fifo addr, length, raw rssi, raw snr) per packet found by poll_rx,
+        # a ring sized for the most 5 byte packets the FIFO can hold
+        self._rx_desc = bytearray(4 * 51)
+        # 1 where the descriptor is a packet that failed CRC, kept only for its FIFO space
+        self._rx_bad = bytearray(51)
+        self._rx_head = 0
+        self._rx_count = 0
+        self._rx_bytes = 0
+        self._drain_buffer = None
+        # FIFO write address followed by the 4 byte RadioHead header
+        self._tx_header = bytearray(5)
+        self._tx_header[0] = _RH_RF95_REG_00_FIFO | 0x80
         self.high_power = high_power
         self.RFM95PW=rfm95pw
         self.dio0=False
+        self._dio0_edges=None
         self.debug=True
         # Device support SPI mode 0 (polarity & phase = 0) up to a max of 10mhz.
         # Set Default Baudrate to 5MHz to avoid problems
         self._device = spidev.SPIDevice(spi, cs, baudrate=baudrate, polarity=0, phase=0)
+        # kept to end one register access and start the next without
+        # releasing the bus, see _strobe
+        self._cs = cs
         # Setup reset as a digital input (default state for reset line according
         # to the datasheet).  This line is pulled low as an output quickly to
         # trigger a reset.  Note that reset MUST be done like this and set as
@@ -294,14 +331,17 @@ class RFM9x:
         self.long_range_mode = True
         if self.operation_mode != SLEEP_MODE or not self.long_range_mode:
             raise RuntimeError("Failed to configure radio for LoRa mode, check wiring!")
+        # registers 0x0D-0x3F mean something else in FSK mode
+        self._invalidate_shadow()
         # clear default setting for access to LF registers if frequency > 525MHz
         if frequency > 525:
             self.low_frequency_mode = 0
-        # Setup entire 256 byte FIFO
-        self._write_u8(_RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, 0x00)
-        self._write_u8(_RH_RF95_REG_0F_FIFO_RX_BASE_ADDR, 0x00)
-        # Disable Freq Hop
-        self._write_u8(_RH_RF95_REG_24_HOP_PERIOD, 0x00)
+        # Setup entire 256 byte FIFO and disable Freq Hop
+        self._write_regs((
+            (_RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, 0x00),
+            (_RH_RF95_REG_0F_FIFO_RX_BASE_ADDR, 0x00),
+            (_RH_RF95_REG_24_HOP_PERIOD, 0x00),
+        ))
         # Set mode idle
         self.idle()
 
@@ -326,6 +366,8 @@ class RFM9x:
            This instantaneous RSSI value may not be accurate once the
            operating mode has been changed.
         """
+        self.last_snr = 0.0
+        """The SNR (in dB) of the last received packet. Stored when the packet was received."""
         # initialize timeouts and delays delays
         self.ack_wait = 0.5
         """The delay time before attempting a retry after not receiving an ACK"""
@@ -343,8 +385,12 @@ class RFM9x:
         """The delay time before attemting to send an ACK.
            If ACKs are being missed try setting this to .1 or .2.
         """
+        # (destination, node, identifier, flags) of an ACK owed by _read_packet
+        self._ack_header = None
         # initialize sequence number counter for reliabe datagram mode
         self.sequence_number = 0
+        # resends of the current packet, counted by send_with_ack
+        self.retry_counter = 0
         # create seen Ids list
         self.seen_ids = bytearray(256)
         # initialize packet header
@@ -372,6 +418,9 @@ class RFM9x:
            Fourth byte of the RadioHead header.
         """
         self.crc_error_count = 0
+        self.stats = LinkStats()
+        """Per-frame link quality records, see LinkStats"""
+        self._tx_slot = None
 
         self.auto_agc=True
         self.pa_ramp=0   # mode agnostic
@@ -391,6 +440,11 @@ class RFM9x:
                     self.preamble_length,
                     self.enable_crc]
 
+        # FSK registers overlap the shadowed LoRa ones, bypass the shadow
+        # until LoRa mode is restored
+        shadow = self.shadow_registers
+        self.shadow_registers = False
+        self._invalidate_shadow()
         self.operation_mode = SLEEP_MODE
         time.sleep(0.01)
         self.long_range_mode=False # FSK/OOK Mode
@@ -424,10 +478,14 @@ class RFM9x:
             self.operation_mode = SLEEP_MODE
             time.sleep(0.01)
             self.long_range_mode = True
-            self._write_u8(_RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, 0x00)
-            self._write_u8(_RH_RF95_REG_0F_FIFO_RX_BASE_ADDR, 0x00)
-            self._write_u8(_RH_RF95_REG_24_HOP_PERIOD, 0x00)
+            self._write_regs((
+                (_RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, 0x00),
+                (_RH_RF95_REG_0F_FIFO_RX_BASE_ADDR, 0x00),
+                (_RH_RF95_REG_24_HOP_PERIOD, 0x00),
+            ))
             self.idle()
+            self.shadow_registers = shadow
+            self.resync()
             self.spreading_factor = cache[0]
             self.signal_bandwidth = cache[1]
             self.coding_rate      = cache[2]
@@ -435,6 +493,8 @@ class RFM9x:
             self.enable_crc       = cache[4]
             self.auto_agc = True
             self.low_datarate_optimize = True
+        else:
+            self.shadow_registers = shadow
         return success
 
 
@@ -462,7 +522,14 @@ class RFM9x:
 
     def _read_u8(self, address):
         # Read a single byte from the provided address and return it.
+        # Shadowed configuration registers come from RAM once known.
+        bit = 1 << (address & 7)
+        if self._shadow_valid[address >> 3] & bit:
+            return self._shadow[address]
         self._read_into(address, self._BUFFER, length=1)
+        if self.shadow_registers and _SHADOW_MASK[address >> 3] & bit:
+            self._shadow[address] = self._BUFFER[0]
+            self._shadow_valid[address >> 3] |= bit
         return self._BUFFER[0]
 
     def _write_from(self, address, buf, length=None):
@@ -480,14 +547,78 @@ class RFM9x:
     def _write_u8(self, address, val):
         # Write a byte register to the chip.  Specify the 7-bit address and the
         # 8-bit value to write to that address.
+        if not self._note_write(address, val):
+            return
         with self._device as device:
-            self._BUFFER[0] = (address | 0x80) & 0xFF  # Set top bit to 1 to
-            # indicate a write.
-            self._BUFFER[1] = val & 0xFF
-            device.write(self._BUFFER, end=2)
+            self._put_u8(device, address, val)
+
+    def _note_write(self, address, val):
+        # Track a register write, returns False if it can be skipped because
+        # a shadowed register already holds the value.
+        val &= 0xFF
+        if address == _RH_RF95_REG_01_OP_MODE:
+            self._op_high = val & 0xF8
+        bit = 1 << (address & 7)
+        if self.shadow_registers and _SHADOW_MASK[address >> 3] & bit:
+            if self._shadow_valid[address >> 3] & bit and self._shadow[address] == val:
+                return False
+            self._shadow[address] = val
+            self._shadow_valid[address >> 3] |= bit
+        return True
+
+    def _put_u8(self, device, address, val):
+        # Write a register inside an already open bus transaction.
+        self._BUFFER[0] = (address | 0x80) & 0xFF  # Set top bit to 1 to
+        # indicate a write.
+        self._BUFFER[1] = val & 0xFF
+        device.write(self._BUFFER, end=2)
+
+    def _strobe(self):
+        # End the current register access and start the next one while
+        # keeping the bus locked and configured (chip select is active low).
+        self._cs.value = True
+        self._cs.value = False
+
+    def _write_regs(self, regs):
+        # Write a sequence of (address, value) registers under one bus lock,
+        # strobing chip select between them.  Unchanged shadowed registers
+        # are left out.
+        first = True
+        with self._device as device:
+            for address, val in regs:
+                if not self._note_write(address, val):
+                    continue
+                if not first:
+                    self._strobe()
+                self._put_u8(device, address, val)
+                first = False
+
+    def _mode_byte(self, mode):
+        if self._op_high is None:
+            self._op_high = self._read_u8(_RH_RF95_REG_01_OP_MODE) & 0xF8
+        return self._op_high | mode
+
+    def _dio0_mapping_byte(self, mapping):
+        return (self._read_u8(_RH_RF95_REG_40_DIO_MAPPING1) & 0x3F) | (mapping << 6)
+
+    def _invalidate_shadow(self):
+        for i in range(len(self._shadow_valid)):
+            self._shadow_valid[i] = 0
+
+    def resync(self):
+        """Reload the register shadow from the chip.  Only needed if the
+        configuration registers were changed behind this driver's back.
+        """
+        self._invalidate_shadow()
+        if self.shadow_registers:
+            for address in range(128):
+                if _SHADOW_MASK[address >> 3] & (1 << (address & 7)):
+                    self._read_u8(address)
 
     def reset(self):
         """Perform a reset of the chip."""
+        self._invalidate_shadow()
+        self._op_high = None
         # See section 7.2.2 of the datasheet for reset description.
         self._reset.switch_to_output(value=False)
         time.sleep(0.0001)  # 100 us
@@ -496,26 +627,57 @@ class RFM9x:
 
     def idle(self):
         """Enter idle standby mode."""
-        self.operation_mode = STANDBY_MODE
+        self._write_u8(_RH_RF95_REG_01_OP_MODE, self._mode_byte(STANDBY_MODE))
 
     def sleep(self):
         """Enter sleep mode."""
-        self.operation_mode = SLEEP_MODE
+        self._write_u8(_RH_RF95_REG_01_OP_MODE, self._mode_byte(SLEEP_MODE))
 
     def listen(self):
         """Listen for packets to be received by the chip.  Use :py:func:`receive`
         to listen, wait and retrieve packets as they're available.
         """
-        self.operation_mode = RX_MODE
-        self.dio0_mapping = 0b00  # Interrupt on rx done.
+        # map DIO0 before changing mode so the done edge is never missed
+        self._write_regs((
+            (_RH_RF95_REG_40_DIO_MAPPING1, self._dio0_mapping_byte(0b00)),  # Interrupt on rx done.
+            (_RH_RF95_REG_01_OP_MODE, self._mode_byte(RX_MODE)),
+        ))
 
     def transmit(self):
         """Transmit a packet which is queued in the FIFO.  This is a low level
         function for entering transmit mode and more.  For generating and
         transmitting a packet of data use :py:func:`send` instead.
         """
-        self.operation_mode = TX_MODE
-        self.dio0_mapping = 0b01  # Interrupt on tx done.
+        self._write_regs((
+            (_RH_RF95_REG_40_DIO_MAPPING1, self._dio0_mapping_byte(0b01)),  # Interrupt on tx done.
+            (_RH_RF95_REG_01_OP_MODE, self._mode_byte(TX_MODE)),
+        ))
+
+    def attach_dio0(self, pin):
+        """Detect rx/tx done on the DIO0 pin instead of polling IRQ_FLAGS over SPI.
+        A countio edge counter is used when available so the done edge is
+        latched even while nothing is polling, otherwise the pin level is read.
+        DIO0 stays high until the IRQ flags are cleared.
+        Setting the dio0 attribute to an input DigitalInOut also works.
+        """
+        try:
+            import countio
+            self._dio0_edges = countio.Counter(pin, edge=countio.Edge.RISE)
+        except (ImportError, AttributeError, TypeError):
+            self.dio0 = digitalio.DigitalInOut(pin)
+            self.dio0.switch_to_input()
+
+    def _dio0_high(self):
+        if self._dio0_edges is not None:
+            return self._dio0_edges.count > 0
+        return self.dio0.value
+
+    def _clear_irq(self):
+        # reset the edge count first, a done edge that lands in between is
+        # still counted and its packet is still in the FIFO
+        if self._dio0_edges is not None:
+            self._dio0_edges.reset()
+        self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
 
     @property
     def preamble_length(self):
@@ -530,8 +692,10 @@ class RFM9x:
     @preamble_length.setter
     def preamble_length(self, val):
         assert 0 <= val <= 65535
-        self._write_u8(_RH_RF95_REG_20_PREAMBLE_MSB, (val >> 8) & 0xFF)
-        self._write_u8(_RH_RF95_REG_21_PREAMBLE_LSB, val & 0xFF)
+        self._write_regs((
+            (_RH_RF95_REG_20_PREAMBLE_MSB, (val >> 8) & 0xFF),
+            (_RH_RF95_REG_21_PREAMBLE_LSB, val & 0xFF),
+        ))
 
     @property
     def frequency_mhz(self):
@@ -555,9 +719,11 @@ class RFM9x:
         msb = frf >> 16
         mid = (frf >> 8) & 0xFF
         lsb = frf & 0xFF
-        self._write_u8(_RH_RF95_REG_06_FRF_MSB, msb)
-        self._write_u8(_RH_RF95_REG_07_FRF_MID, mid)
-        self._write_u8(_RH_RF95_REG_08_FRF_LSB, lsb)
+        self._write_regs((
+            (_RH_RF95_REG_06_FRF_MSB, msb),
+            (_RH_RF95_REG_07_FRF_MID, mid),
+            (_RH_RF95_REG_08_FRF_LSB, lsb),
+        ))
 
     @property
     def tx_power(self):
@@ -611,6 +777,20 @@ class RFM9x:
     def packet_status(self):
         return (self.rssi,self._read_u8(_RH_RF95_REG_19_PKT_SNR_VALUE)/4)
 
+    def time_on_air(self, length):
+        """Seconds to transmit a packet of length bytes (RadioHead header
+        included) with the current modem settings, per Semtech AN1200.13."""
+        sf = self.spreading_factor
+        t_sym = (1 << sf) / self.signal_bandwidth
+        de = 1 if self.low_datarate_optimize else 0
+        crc = 1 if self.enable_crc else 0
+        # explicit header mode
+        bits = 8 * length - 4 * sf + 28 + 16 * crc
+        per_block = 4 * (sf - 2 * de)
+        blocks = max(-(-bits // per_block), 0)
+        payload_symbols = 8 + blocks * self.coding_rate
+        return (self.preamble_length + 4.25 + payload_symbols) * t_sym
+
     @property
     def pll_timeout(self):
         return (self._read_u8(_RH_RF95_REG_1C_HOP_CHANNEL))
@@ -736,17 +916,14 @@ class RFM9x:
 
     def tx_done(self):
         """Transmit status"""
-        # if self.dio0:
-        #     print('TxDIO0: {}, {}'.format(self.dio0.value,hex((self._read_u8(_RH_RF95_REG_12_IRQ_FLAGS) & 0x8) >> 3)))
-        #     return self.dio0.value
+        if self.dio0 or self._dio0_edges is not None:
+            return self._dio0_high()
         return (self._read_u8(_RH_RF95_REG_12_IRQ_FLAGS) & 0x8) >> 3
 
     def rx_done(self):
         """Receive status"""
-        # if self.dio0:
-        #     print('RxDIO0: {}, {}'.format(self.dio0.value,hex((self._read_u8(_RH_RF95_REG_12_IRQ_FLAGS) & 0x40) >> 6)))
-        #     return self.dio0.value
-        # else:
+        if self.dio0 or self._dio0_edges is not None:
+            return self._dio0_high()
         return (self._read_u8(_RH_RF95_REG_12_IRQ_FLAGS) & 0x40) >> 6
 
     def crc_error(self):
@@ -776,6 +953,38 @@ class RFM9x:
 
            Returns: True if success or False if the send timed out.
         """
+        self._start_send(data, destination, node, identifier, flags)
+        start = time.monotonic()
+        timed_out = False
+        while not timed_out and not self.tx_done():
+            if (time.monotonic() - start) >= self.xmit_timeout:
+                timed_out = True
+        return self._finish_send(keep_listening, timed_out)
+
+    async def asend(
+        self,
+        data,
+        *,
+        keep_listening=False,
+        destination=None,
+        node=None,
+        identifier=None,
+        flags=None
+    ):
+        """Same as :py:func:`send` but yields to the asyncio loop while the
+           packet is on air.
+        """
+        self._start_send(data, destination, node, identifier, flags)
+        start = time.monotonic()
+        timed_out = False
+        while not timed_out and not self.tx_done():
+            if (time.monotonic() - start) >= self.xmit_timeout:
+                timed_out = True
+            await asyncio.sleep(0)
+        return self._finish_send(keep_listening, timed_out)
+
+    def _start_send(self, data, destination, node, identifier, flags):
+        # Fill the FIFO and start transmitting, shared by send and asend.
         # Disable pylint warning to not use length as a check for zero.
         # This is a puzzling warning as the below code is clearly the most
         # efficient and proper way to ensure a precondition that the provided
@@ -786,61 +995,73 @@ class RFM9x:
             self.txrx[0].value=True
             self.txrx[1].value=False
 
+        if isinstance(data, str):
+            data = data.encode()
         l=len(data)
         assert 0 < l <= 252
         # pylint: enable=len-as-condition
-        self.idle()  # Stop receiving to clear FIFO and keep it clear.
         l+=4
-        # Fill the FIFO with a packet to send.
-        self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR, 0x00)  # FIFO starts at 0.
-
-        # Combine header and data to form payload
-        if data == b'!':
-            payload = bytearray(5)
-        else:
-            payload = self.buffview[:l]
+        self._tx_len = l
 
+        # The header goes out from its own small buffer and the data is
+        # written to the FIFO straight from the caller's buffer (a memoryview
+        # into a ptp frame works), so nothing is copied.
+        header = self._tx_header
         if destination is None:  # use attribute
-            payload[0] = self.destination
+            header[1] = self.destination
         else:  # use kwarg
-            payload[0] = destination
+            header[1] = destination
         if node is None:  # use attribute
-            payload[1] = self.node
+            header[2] = self.node
         else:  # use kwarg
-            payload[1] = node
+            header[2] = node
         if identifier is None:  # use attribute
-            payload[2] = self.identifier
+            header[3] = self.identifier
         else:  # use kwarg
-            payload[2] = identifier
+            header[3] = identifier
         if flags is None:  # use attribute
-            payload[3] = self.flags
+            header[4] = self.flags
         else:  # use kwarg
-            payload[3] = flags
-        if self.DEBUG_HEADER: print('[header] - {}'.format([hex(i) for i in payload]))
-        # payload = payload + data
-        try:
-            if isinstance(data,(bytes,bytearray,memoryview)):
-                payload[4:]=data[:]
-            else:
-                payload[4:]=data.encode()
-        except Exception as e:
-            print('payload encoding error:',e)
-            payload = bytearray(payload[:4])+data
-
-        # Write payload.
-        self._write_from(_RH_RF95_REG_00_FIFO, payload)
-        # Write payload and header length.
-        self._write_u8(_RH_RF95_REG_22_PAYLOAD_LENGTH, l)
-        # Turn on transmit mode to send out the packet.
-        self.transmit()
-        # Wait for tx done interrupt with explicit polling (not ideal but
-        # best that can be done right now without interrupts).
-        start = time.monotonic()
-        timed_out = False
-        while not timed_out and not self.tx_done():
-            if (time.monotonic() - start) >= self.xmit_timeout:
-                timed_out = True
+            header[4] = flags
+        if self.DEBUG_HEADER: print('[header] - {}'.format([hex(i) for i in header[1:]]))
 
+        standby = self._mode_byte(STANDBY_MODE)
+        tx = self._mode_byte(TX_MODE)
+        mapping = self._dio0_mapping_byte(0b01)  # Interrupt on tx done.
+        with self._device as device:
+            # Stop receiving to clear FIFO and keep it clear.
+            self._put_u8(device, _RH_RF95_REG_01_OP_MODE, standby)
+            self._strobe()
+            self._put_u8(device, _RH_RF95_REG_0D_FIFO_ADDR_PTR, 0x00)  # FIFO starts at 0.
+            self._strobe()
+            # Write header and payload in one FIFO burst.
+            device.write(header)
+            device.write(data)
+            # Write payload and header length.
+            if self._note_write(_RH_RF95_REG_22_PAYLOAD_LENGTH, l):
+                self._strobe()
+                self._put_u8(device, _RH_RF95_REG_22_PAYLOAD_LENGTH, l)
+            if self._note_write(_RH_RF95_REG_40_DIO_MAPPING1, mapping):
+                self._strobe()
+                self._put_u8(device, _RH_RF95_REG_40_DIO_MAPPING1, mapping)
+            # Forget a done edge or flag left from listening, or it would
+            # read as tx done as soon as transmit mode is on.
+            if self._dio0_edges is not None:
+                self._dio0_edges.reset()
+            self._strobe()
+            self._put_u8(device, _RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+            # Turn on transmit mode to send out the packet.
+            self._note_write(_RH_RF95_REG_01_OP_MODE, tx)
+            self._strobe()
+            self._put_u8(device, _RH_RF95_REG_01_OP_MODE, tx)
+        # The caller waits for tx done, on DIO0 when attached or else by
+        # polling IRQ_FLAGS.
+
+    def _finish_send(self, keep_listening, timed_out):
+        retries = self.retry_counter if self._tx_header[4] & _RH_FLAGS_RETRY else 0
+        self._tx_slot = self.stats.record(
+            LinkStats.TX, self._tx_len, ok=not timed_out, retries=retries,
+            airtime=self.time_on_air(self._tx_len))
         if hasattr(self,'txrx'): # RX
             self.txrx[0].value=False
             self.txrx[1].value=True
@@ -852,7 +1073,7 @@ class RFM9x:
             # Enter idle mode to stop receiving other packets.
             self.idle()
         # Clear interrupt.
-        self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        self._clear_irq()
         return not timed_out
 
     def send_with_ack(self, data):
@@ -886,6 +1107,7 @@ class RFM9x:
                             break
             # pause before next retry -- random delay
             if not got_ack:
+                self.stats.fail(self._tx_slot)
                 self.retry_counter+=1 # ADDED FOR PYCUBED
                 print('no uhf ack, sending again...')
                 # delay by random amount before next try
@@ -896,6 +1118,43 @@ class RFM9x:
         self.flags = 0  # clear flags
         return got_ack
 
+    async def asend_with_ack(self, data):
+        """Same as :py:func:`send_with_ack` but yields to the asyncio loop
+           while sending, waiting for the ACK and backing off.
+        """
+        if self.ack_retries:
+            retries_remaining = self.ack_retries
+        else:
+            retries_remaining = 1
+        got_ack = False
+        self.retry_counter=0 # ADDED FOR PYCUBED
+        self.sequence_number = (self.sequence_number + 1) & 0xFF
+        while not got_ack and retries_remaining:
+            self.identifier = self.sequence_number
+            await self.asend(data, keep_listening=True)
+            # Don't look for ACK from Broadcast message
+            if self.destination == _RH_BROADCAST_ADDRESS:
+                got_ack = True
+            else:
+                # wait for a packet from our destination
+                ack_packet = await self.areceive(timeout=self.ack_wait, with_header=True)
+                if ack_packet is not None:
+                    if ack_packet[3] & _RH_FLAGS_ACK:
+                        # check the ID
+                        if ack_packet[2] == self.identifier:
+                            got_ack = True
+                            break
+            # pause before next retry -- random delay
+            if not got_ack:
+                self.stats.fail(self._tx_slot)
+                self.retry_counter+=1 # ADDED FOR PYCUBED
+                await asyncio.sleep(self.ack_wait + self.ack_wait * random())
+            retries_remaining = retries_remaining - 1
+            # set retry flag in packet header
+            self.flags |= _RH_FLAGS_RETRY
+        self.flags = 0  # clear flags
+        return got_ack
+
     # pylint: disable=too-many-branches
     def receive(
         self, *, keep_listening=True, with_header=False, with_ack=False, timeout=None, debug=False, view=False):
@@ -921,10 +1180,8 @@ class RFM9x:
         if timeout is None:
             timeout = self.receive_timeout
         if timeout is not None:
-            # Wait for the payload_ready signal.  This is not ideal and will
-            # surely miss or overflow the FIFO when packets aren't read fast
-            # enough, however it's the best that can be done from Python without
-            # interrupt supports.
+            # Wait for the payload_ready signal, on DIO0 when attached or else
+            # by polling IRQ_FLAGS.
             # Make sure we are listening for packets.
             self.listen()
             start = time.monotonic()
@@ -932,33 +1189,76 @@ class RFM9x:
             while not timed_out and not self.rx_done():
                 if (time.monotonic() - start) >= timeout:
                     timed_out = True
-        # Payload ready is set, a packet is in the FIFO.
+        packet = self._read_packet(timed_out, keep_listening, with_header, with_ack, debug, view)
+        if self._ack_header is not None:
+            # delay before sending Ack to give receiver a chance to get ready
+            if self.ack_delay is not None:
+                time.sleep(self.ack_delay)
+            self._send_ack(self.send, keep_listening, debug)
+        return packet
+
+    async def areceive(
+        self, *, keep_listening=True, with_header=False, with_ack=False, timeout=None, debug=False, view=False):
+        """Same as :py:func:`receive` but yields to the asyncio loop while
+           waiting for a packet.
+        """
+        if hasattr(self,'txrx'): # RX
+            self.txrx[0].value=False
+            self.txrx[1].value=True
+
+        timed_out = False
+        if timeout is None:
+            timeout = self.receive_timeout
+        if timeout is not None:
+            self.listen()
+            start = time.monotonic()
+            timed_out = False
+            while not timed_out and not self.rx_done():
+                if (time.monotonic() - start) >= timeout:
+                    timed_out = True
+                await asyncio.sleep(0)
+        packet = self._read_packet(timed_out, keep_listening, with_header, with_ack, debug, view)
+        if self._ack_header is not None:
+            if self.ack_delay is not None:
+                await asyncio.sleep(self.ack_delay)
+            await self._send_ack(self.asend, keep_listening, debug)
+        return packet
+
+    def _send_ack(self, send, keep_listening, debug):
+        # send ACK packet to sender (data is b'!'), with send or asend
+        destination, node, identifier, flags = self._ack_header
+        self._ack_header = None
+        if debug: print('Sending Ack to {}'.format(destination))
+        return send(
+            b"!",
+            keep_listening=keep_listening,
+            destination=destination,
+            node=node,
+            identifier=identifier,
+            flags=flags,
+        )
+
+    def _read_packet(self, timed_out, keep_listening, with_header, with_ack, debug, view):
+        # Read out a received packet, shared by receive and areceive.
+        # Payload ready is set, a packet is in the FIFO. An ACK that is due
+        # is left in _ack_header for the caller to send, blocking or not.
         packet = None
-        # save last RSSI reading
-        self.last_rssi = self.rssi(raw=True)
-        # Enter idle mode to stop receiving other packets.
-        self.idle()
-        if not timed_out:
-            if self.enable_crc and self.crc_error():
+        self._ack_header = None
+        if timed_out:
+            # Enter idle mode to stop receiving other packets.
+            self.idle()
+        else:
+            fifo_length, crc_failed = self._read_fifo_burst()
+            if crc_failed:
                 self.crc_error_count += 1
                 print('crc error')
                 if hasattr(self,'crc_errs'):
                     self.crc_errs+=1
             else:
-                # Read the data from the FIFO.
-                # Read the length of the FIFO.
-                fifo_length = self._read_u8(_RH_RF95_REG_13_RX_NB_BYTES)
+                if fifo_length > 0:
+                    packet = self.buffview[:fifo_length]
                 # Handle if the received packet is too small to include the 4 byte
                 # RadioHead header and at least one byte of data --reject this packet and ignore it.
-                if fifo_length > 0:  # read and clear the FIFO if anything in it
-                    current_addr = self._read_u8(_RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR)
-                    self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR, current_addr)
-                    # packet = bytearray(fifo_length)
-                    packet = self.buffview[:fifo_length]
-                    # Read the packet.
-                    self._read_into(_RH_RF95_REG_00_FIFO, packet)
-                # Clear interrupt.
-                self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
                 if fifo_length < 5:
                     print('missing pckt header')
                     packet = None
@@ -975,19 +1275,7 @@ class RFM9x:
                         and ((packet[3] & _RH_FLAGS_ACK) == 0)
                         and (packet[0] != _RH_BROADCAST_ADDRESS)
                     ):
-                        # delay before sending Ack to give receiver a chance to get ready
-                        if self.ack_delay is not None:
-                            time.sleep(self.ack_delay)
-                        # send ACK packet to sender (data is b'!')
-                        self.send(
-                            b"!",
-                            keep_listening=keep_listening,
-                            destination=packet[1],
-                            node=packet[0],
-                            identifier=packet[2],
-                            flags=(packet[3] | _RH_FLAGS_ACK),
-                        )
-                        if debug: print('Sent Ack to {}'.format(packet[1]))
+                        self._ack_header = (packet[1], packet[0], packet[2], packet[3] | _RH_FLAGS_ACK)
                         if debug: print('\t{}'.format(packet))
 
                         # # reject Retries if we have seen this idetifier from this source before
@@ -1014,71 +1302,181 @@ class RFM9x:
             # Enter idle mode to stop receiving other packets.
             self.idle()
         # Clear interrupt.
-        self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        self._clear_irq()
         if view:
             return packet
         elif packet is not None:
             return bytes(packet)
         return packet
 
-    def receive_all(self, only_for_me=True,debug=False):
-        # msg=[]
-        l=0
-        fifo_length=0
-        self.idle()
-        if self.enable_crc and self.crc_error():
+    def _read_fifo_burst(self):
+        # Stop receiving, then read the packet status and RSSI, the FIFO and
+        # clear the interrupt, all under one bus lock.
+        # Returns (fifo_length, crc_failed).
+        check_crc = self.enable_crc
+        standby = self._mode_byte(STANDBY_MODE)
+        status = self._rx_status
+        with self._device as device:
+            # 0x10 FIFO_RX_CURRENT_ADDR, 0x12 IRQ_FLAGS, 0x13 RX_NB_BYTES,
+            # 0x19 PKT_SNR_VALUE, 0x1A PKT_RSSI_VALUE
+            self._BUFFER[0] = _RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR
+            device.write(self._BUFFER, end=1)
+            device.readinto(status)
+            self._strobe()
+            # Enter idle mode to stop receiving other packets.
+            self._put_u8(device, _RH_RF95_REG_01_OP_MODE, standby)
+            crc_failed = check_crc and status[2] & 0x20
+            fifo_length = 0 if crc_failed else status[3]
+            if fifo_length > 0:  # read and clear the FIFO if anything in it
+                self._strobe()
+                self._put_u8(device, _RH_RF95_REG_0D_FIFO_ADDR_PTR, status[0])
+                self._strobe()
+                self._BUFFER[0] = _RH_RF95_REG_00_FIFO
+                device.write(self._BUFFER, end=1)
+                device.readinto(self.buffview, end=fifo_length)
+            if not crc_failed:
+                # Clear interrupt.
+                if self._dio0_edges is not None:
+                    self._dio0_edges.reset()
+                self._strobe()
+                self._put_u8(device, _RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        self._note_write(_RH_RF95_REG_01_OP_MODE, standby)
+        # save last RSSI and SNR reading
+        self.last_rssi = status[10]
+        self.last_snr = self._snr_db(status[9])
+        self.stats.record(
+            LinkStats.RX, status[3], ok=not crc_failed, rssi=status[10] - 137,
+            snr=self.last_snr, airtime=self.time_on_air(status[3]))
+        return fifo_length, bool(crc_failed)
+
+    def poll_rx(self):
+        """Record where the last received packet sits in the FIFO, without reading it.
+
+        In continuous receive the modem writes each packet after the one
+        before, so calling this once per rx done (it is one short register
+        burst) is enough to split the FIFO into exact packets later with
+        drain_rx(). The radio keeps listening.
+        Returns True if a packet was recorded.
+        """
+        if not self.rx_done():
+            return False
+        status = self._rx_status
+        with self._device as device:
+            # 0x10 FIFO_RX_CURRENT_ADDR, 0x12 IRQ_FLAGS, 0x13 RX_NB_BYTES,
+            # 0x19 PKT_SNR_VALUE, 0x1A PKT_RSSI_VALUE
+            self._BUFFER[0] = _RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR
+            device.write(self._BUFFER, end=1)
+            device.readinto(status)
+            if self._dio0_edges is not None:
+                self._dio0_edges.reset()
+            self._strobe()
+            self._put_u8(device, _RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        crc_failed = self.enable_crc and status[2] & 0x20
+        self.stats.record(
+            LinkStats.RX, status[3], ok=not crc_failed, rssi=status[10] - 137,
+            snr=self._snr_db(status[9]), airtime=self.time_on_air(status[3]))
+        if status[3] == 0:
+            return False
+        desc = self._rx_desc
+        if self._rx_count == len(desc) // 4:
+            self._drop_rx_desc()
+        slot = (self._rx_head + self._rx_count) % (len(desc) // 4)
+        i = slot * 4
+        desc[i] = status[0]
+        desc[i + 1] = status[3]
+        desc[i + 2] = status[10]
+        desc[i + 3] = status[9]
+        # a packet that failed CRC still took FIFO space, so it is kept
+        # for the overwrite check below and skipped by drain_rx()
+        self._rx_bad[slot] = 1 if crc_failed else 0
+        self._rx_count += 1
+        self._rx_bytes += status[3]
+        # the FIFO is 256 bytes, older packets have been written over
+        while self._rx_bytes > 256:
+            self._drop_rx_desc()
+        if crc_failed:
             self.crc_error_count += 1
-            print('crc error')
-            if hasattr(self,'crc_errs'):
-                self.crc_errs+=1
-        else:
-            fifo_length = self._read_u8(_RH_RF95_REG_13_RX_NB_BYTES)
-
-        if fifo_length > 0:
-            current_addr = self._read_u8(_RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR)
-            self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR, _RH_RF95_REG_00_FIFO)
-            self._read_into(_RH_RF95_REG_00_FIFO,_bigbuffer)
-            for i in range(4):
-                self._write_from(_RH_RF95_REG_00_FIFO, bytes(64))
-            self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR,_RH_RF95_REG_00_FIFO)
-            self.listen()
-            # Clear interrupt.
-            self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
-            packetindex=[]
-            i=0
-            while i < 253: # 256-4 = 252
-                # check first
-                if self.buffview[i] in self.valid_ids:
-                    # check second
-                    if self.buffview[i+1] in self.valid_ids:
-                        # make sure not the same
-                        if self.buffview[i]!=self.buffview[i+1]:
-                            # append first
-                            packetindex.append(i)
-                            i=i+4
-                            l+=1
-                            continue
-                i+=1
-            for i in range(l-1):
-                # assume packets are back-to-back (read till index of next one)
-                # if (packetindex[i+1]-packetindex[i]) <= 10:
-                    # msg.append(bytes(self.buffview[packetindex[i]:packetindex[i+1]]))
-                yield self.buffview[packetindex[i]:packetindex[i+1]]
-            # last packet so read until the end of our fifo_length
-            if packetindex:
-                # if (packetindex[-1]-(current_addr+fifo_length)) <= 10:
-                    # print('{},{},{}'.format(packetindex[-1],current_addr,fifo_length))
-                    # msg.append(bytes(self.buffview[packetindex[-1]:current_addr+fifo_length]))
-                yield self.buffview[packetindex[-1]:current_addr+fifo_length]
-        else:
-            self.listen()
-            # Clear interrupt.
-            self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+            return False
+        self.last_rssi = status[10]
+        self.last_snr = self._snr_db(status[9])
+        return True
+
+    def _drop_rx_desc(self):
+        self._rx_bytes -= self._rx_desc[self._rx_head * 4 + 1]
+        self._rx_head = (self._rx_head + 1) % (len(self._rx_desc) // 4)
+        self._rx_count -= 1
+
+    def drain_rx(self, only_for_me=True):
+        """Read the whole FIFO in one burst and split it into the packets recorded by poll_rx().
+
+        Yields (packet, rssi, snr) for each packet, oldest first. packet
+        includes the 4 byte RadioHead header and is a view into a buffer
+        reused by the next drain, rssi is in dBm and snr in dB. The radio is
+        left listening with an empty FIFO.
+        """
+        if self._drain_buffer is None:
+            # twice the FIFO so a packet that wraps past 0xFF stays contiguous
+            self._drain_buffer = bytearray(512)
+        buf = self._drain_buffer
+        view = memoryview(buf)
+        standby = self._mode_byte(STANDBY_MODE)
+        with self._device as device:
+            self._put_u8(device, _RH_RF95_REG_01_OP_MODE, standby)
+            self._strobe()
+            self._put_u8(device, _RH_RF95_REG_0D_FIFO_ADDR_PTR, 0x00)
+            self._strobe()
+            self._BUFFER[0] = _RH_RF95_REG_00_FIFO
+            device.write(self._BUFFER, end=1)
+            device.readinto(buf, end=256)
+            if self._dio0_edges is not None:
+                self._dio0_edges.reset()
+            self._strobe()
+            self._put_u8(device, _RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        self._note_write(_RH_RF95_REG_01_OP_MODE, standby)
+        # receiving starts again from FIFO_RX_BASE_ADDR
+        self.listen()
+        head = self._rx_head
+        count = self._rx_count
+        slots = len(self._rx_desc) // 4
+        self._rx_head = self._rx_count = self._rx_bytes = 0
+        wrapped = False
+        for n in range(count):
+            slot = (head + n) % slots
+            i = slot * 4
+            addr = self._rx_desc[i]
+            length = self._rx_desc[i + 1]
+            if addr + length > 256 and not wrapped:
+                buf[256:512] = view[0:256]
+                wrapped = True
+            if length < 5 or self._rx_bad[slot]:
+                continue
+            packet = view[addr:addr + length]
+            if (
+                only_for_me
+                and self.node != _RH_BROADCAST_ADDRESS
+                and packet[0] != _RH_BROADCAST_ADDRESS
+                and packet[0] != self.node
+            ):
+                continue
+            yield packet, self._rx_desc[i + 2] - 137, self._snr_db(self._rx_desc[i + 3])
+
+    def _snr_db(self, raw):
+        # PKT_SNR_VALUE is two's complement in quarter dB steps
+        if raw > 127:
+            raw -= 256
+        return raw / 4
 
-        # if only_for_me:
-        #     return [i for i in msg if msg[0] is self.node]
-        # else:
-        #     return msg
+    def receive_all(self, only_for_me=True,debug=False):
+        """Drain every packet buffered in the FIFO, see poll_rx() and drain_rx()
+
+        Yields packets (with the RadioHead header) as views into the drain
+        buffer. Packets received since the last poll_rx() other than the
+        newest cannot be located and are lost, so poll between bursts.
+        """
+        self.poll_rx()
+        for packet, rssi, snr in self.drain_rx(only_for_me):
+            if debug: print('{} rssi:{} snr:{}'.format(bytes(packet), rssi, snr))
+            yield packet
 
     def send_fast(self,data,l):
         self.idle()
@@ -1096,6 +1494,181 @@ class RFM9x:
             pass
         self.idle()
         # Clear interrupt.
-        self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        self._clear_irq()
         return
 
+
+
+class PacketStream:
+    """Adapts an RFM9x to the protocol interface used by ptp.AsyncPacketTransferProtocol.
+
+    Every radio packet carries one ptp frame. read() and read_into_stream()
+    consume the current packet and wait for the next one once it is used up,
+    a remainder shorter than the read is dropped. All waiting is done with
+    the async radio calls so the asyncio loop keeps running.
+
+    send_with_ack() is the ptp level handshake: the frame is resent until
+    the receiver answers with b"ACK".
+    """
+
+    def __init__(self, radio, timeout=None):
+        self.radio = radio
+        self.timeout = timeout
+        self._packet = None
+        self._pos = 0
+
+    async def _ensure(self, n):
+        if self._packet is None or len(self._packet) - self._pos < n:
+            # views into the radio buffer, valid until the next send/receive
+            self._packet = await self.radio.areceive(timeout=self.timeout, view=True)
+            self._pos = 0
+        return self._packet is not None and len(self._packet) - self._pos >= n
+
+    async def read(self, n):
+        if not await self._ensure(n):
+            self._packet = None
+            return None
+        # a view, not a copy: consume it before the next read
+        data = self._packet[self._pos:self._pos + n]
+        self._pos += n
+        return data
+
+    async def read_into_stream(self, n, stream):
+        if self._packet is None or len(self._packet) - self._pos < n:
+            self._packet = None
+            return False
+        stream.write(self._packet[self._pos:self._pos + n])
+        self._pos += n
+        return True
+
+    def send(self, data):
+        return self.radio.send(data, keep_listening=True)
+
+    async def asend(self, data):
+        return await self.radio.asend(data, keep_listening=True)
+
+    async def send_with_ack(self, data):
+        for _ in range(self.radio.ack_retries or 1):
+            await self.radio.asend(data, keep_listening=True)
+            reply = await self.radio.areceive(timeout=self.radio.ack_wait)
+            if reply == b"ACK":
+                return True
+            await asyncio.sleep(self.radio.ack_wait * random())
+        return False
+
+
+class LinkStats:
+    """Fixed-size ring of per-frame link records with summary statistics.
+
+    Each record holds the time, direction, length (RadioHead header
+    included), whether the frame got through (CRC passed on receive, sent
+    and acknowledged when an ACK was expected on transmit), the attempt
+    number of a retransmission, RSSI (dBm), SNR (dB) and airtime (s).
+    Storage is preallocated so recording a frame does not allocate.
+    """
+
+    RX = 0
+    TX = 1
+
+    def __init__(self, size=64):
+        self.size = size
+        self.time = array.array('f', bytes(4 * size))
+        self.snr = array.array('f', bytes(4 * size))
+        self.airtime = array.array('f', bytes(4 * size))
+        self.rssi = array.array('h', bytes(2 * size))
+        self.length = array.array('H', bytes(2 * size))
+        self.ok = bytearray(size)
+        self.direction = bytearray(size)
+        self.retries = bytearray(size)
+        self.count = 0
+        self.next = 0
+
+    def record(self, direction, length, ok=True, retries=0, rssi=0, snr=0.0, airtime=0.0):
+        """Add a frame, overwriting the oldest once full. Returns its slot."""
+        i = self.next
+        self.time[i] = time.monotonic()
+        self.direction[i] = direction
+        self.length[i] = length
+        self.ok[i] = 1 if ok else 0
+        self.retries[i] = min(retries, 255)
+        self.rssi[i] = rssi
+        self.snr[i] = snr
+        self.airtime[i] = airtime
+        self.next = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        return i
+
+    def fail(self, slot):
+        """Mark a recorded frame as lost, e.g. a send whose ACK never came."""
+        if slot is not None:
+            self.ok[slot] = 0
+
+    def clear(self):
+        self.count = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slots(self, direction=None):
+        start = (self.next - self.count) % self.size
+        for n in range(self.count):
+            i = (start + n) % self.size
+            if direction is None or self.direction[i] == direction:
+                yield i
+
+    def records(self, direction=None):
+        """Yield (time, direction, length, ok, retries, rssi, snr, airtime), oldest first."""
+        for i in self._slots(direction):
+            yield (self.time[i], self.direction[i], self.length[i], bool(self.ok[i]),
+                   self.retries[i], self.rssi[i], self.snr[i], self.airtime[i])
+
+    def packet_error_rate(self, direction=None):
+        frames = lost = 0
+        for i in self._slots(direction):
+            frames += 1
+            lost += not self.ok[i]
+        return lost / frames if frames else 0.0
+
+    def goodput(self, direction=None):
+        """Bytes per second of frames that got through, over the recorded span."""
+        first = last = None
+        good = 0
+        for i in self._slots(direction):
+            if first is None:
+                first = self.time[i] - self.airtime[i]
+            last = self.time[i]
+            if self.ok[i]:
+                good += self.length[i]
+        if first is None or last <= first:
+            return 0.0
+        return good / (last - first)
+
+    def retry_ratio(self):
+        """Share of transmitted frames that were retransmissions."""
+        sent = retried = 0
+        for i in self._slots(self.TX):
+            sent += 1
+            retried += self.retries[i] > 0
+        return retried / sent if sent else 0.0
+
+    def airtime_used(self, direction=None):
+        return sum(self.airtime[i] for i in self._slots(direction))
+
+    def rssi_percentiles(self, percentiles=(10, 50, 90)):
+        """RSSI (dBm) of received frames at each percentile, None if none received."""
+        values = sorted(self.rssi[i] for i in self._slots(self.RX))
+        if not values:
+            return None
+        return [values[min(len(values) - 1, p * len(values) // 100)] for p in percentiles]
+
+    def summary(self):
+        return {
+            "frames": self.count,
+            "per": self.packet_error_rate(),
+            "goodput": self.goodput(),
+            "retry_ratio": self.retry_ratio(),
+            "airtime": self.airtime_used(),
+            "rssi_percentiles": self.rssi_percentiles(),
+        }
@@ -0,0 +1,441 @@
+"""
+`uplink`
+====================================================
+
+Code uplink messages shared by the sender (CPython) and the boards
+
+Implementation Notes
+--------------------
+A message is a JSON object with the target ``filepath`` and the crc32 of
+the new contents in ``crc``. In ``full`` mode ``data`` holds the whole
+file, base64 encoded. In ``delta`` mode ``patch`` holds a base64 binary
+patch against the file whose crc32 is ``base_crc``. A patch is a run of
+ops: ``0x01`` copy (big endian u32 offset and u32 length into the old
+file) or ``0x02`` insert (u32 length, then the bytes). Messages without a
+``mode`` are the old plain text ``{"filepath", "data"}`` format.
+
+Whole files can also be sent as a binary frame, see build_frame(), which
+skips the base64 and JSON overhead and is told apart by its magic bytes.
+
+The receiver writes the result to a temp file, checks its crc32 and only
+then moves it over the target, and skips files that already match.
+
+"""
+import os
+import struct
+import binascii
+
+OP_COPY = 0x01
+OP_INSERT = 0x02
+
+
+def crc32_file(path, block_size=512):
+    """crc32 of a file read in blocks, None if it does not exist"""
+    crc = 0
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                crc = binascii.crc32(block, crc)
+    except OSError:
+        return None
+    return crc & 0xFFFFFFFF
+
+
+def make_patch(base, target):
+    """Binary patch that turns base into target, both bytes
+
+    Matches whole lines, which suits source files. Needs difflib, so only
+    the sender can build patches.
+    """
+    import difflib
+    base_lines = base.splitlines(True)
+    target_lines = target.splitlines(True)
+    base_offsets = [0]
+    for line in base_lines:
+        base_offsets.append(base_offsets[-1] + len(line))
+    target_offsets = [0]
+    for line in target_lines:
+        target_offsets.append(target_offsets[-1] + len(line))
+    patch = bytearray()
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            start = base_offsets[i1]
+            patch += struct.pack('>BII', OP_COPY, start, base_offsets[i2] - start)
+        elif tag in ('replace', 'insert'):
+            data = target[target_offsets[j1]:target_offsets[j2]]
+            patch += struct.pack('>BI', OP_INSERT, len(data)) + data
+    return bytes(patch)
+
+
+def apply_patch(base_path, patch, out_path, block_size=512):
+    """Write the result of a patch to out_path, reading base_path in blocks"""
+    patch = memoryview(patch)
+    i = 0
+    with open(base_path, 'rb') as base, open(out_path, 'wb') as out:
+        while i < len(patch):
+            op = patch[i]
+            if op == OP_COPY:
+                offset, length = struct.unpack('>II', patch[i + 1:i + 9])
+                i += 9
+                base.seek(offset)
+                while length:
+                    block = base.read(min(length, block_size))
+                    if not block:
+                        raise ValueError("patch reads past the end of the file")
+                    out.write(block)
+                    length -= len(block)
+            elif op == OP_INSERT:
+                length = struct.unpack('>I', patch[i + 1:i + 5])[0]
+                i += 5
+                out.write(patch[i:i + length])
+                i += length
+            else:
+                raise ValueError(f"unknown patch op {op}")
+
+
+def build_message(filepath, target, base=None):
+    """Message that updates filepath to target, a delta when base is given and it is smaller
+
+    A base equal to target still gives a (one op) delta, the board checks
+    its own file and answers "unchanged" or "base mismatch".
+
+    Returns:
+        dict: the message
+    """
+    crc = binascii.crc32(target) & 0xFFFFFFFF
+    if base is not None:
+        patch = make_patch(base, target)
+        if len(patch) < len(target):
+            return {
+                "filepath": filepath,
+                "mode": "delta",
+                "base_crc": binascii.crc32(base) & 0xFFFFFFFF,
+                "crc": crc,
+                "patch": _b64encode(patch),
+            }
+    return {
+        "filepath": filepath,
+        "mode": "full",
+        "crc": crc,
+        "data": _b64encode(target),
+    }
+
+
+def apply_message(message):
+    """Apply an uplink message to the local file system
+
+    Returns:
+        str: "ok", "unchanged", "base mismatch" or "crc mismatch"
+    """
+    filepath = message["filepath"]
+    mode = message.get("mode")
+    if mode is None:
+        # old format, plain text replaces the file
+        _write_file(filepath, message["data"].encode('utf-8'))
+        return "ok"
+    crc = message["crc"]
+    current = crc32_file(filepath)
+    if current == crc:
+        return "unchanged"
+    tmp = filepath + ".new"
+    if mode == "delta":
+        if current != message["base_crc"]:
+            return "base mismatch"
+        apply_patch(filepath, binascii.a2b_base64(message["patch"]), tmp)
+    else:
+        with open(tmp, 'wb') as f:
+            f.write(binascii.a2b_base64(message["data"]))
+    if crc32_file(tmp) != crc:
+        os.remove(tmp)
+        return "crc mismatch"
+    replace(tmp, filepath)
+    return "ok"
+
+
+# A frame carries a whole file as raw bytes instead of base64 in JSON:
+#   magic, u8 version, u16 path length, u32 data length, u32 crc32, path, data
+FRAME_MAGIC = b'UF'
+FRAME_VERSION = 1
+FRAME_HEADER = '>2sBHII'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+
+
+def build_frame(filepath, data):
+    """Binary frame that replaces filepath with data"""
+    path = filepath.encode('utf-8')
+    crc = binascii.crc32(data) & 0xFFFFFFFF
+    return struct.pack(FRAME_HEADER, FRAME_MAGIC, FRAME_VERSION, len(path), len(data), crc) + path + data
+
+
+def is_frame(payload):
+    return len(payload) >= FRAME_HEADER_SIZE and bytes(payload[:2]) == FRAME_MAGIC
+
+
+def apply_frame(payload):
+    """Apply a binary frame to the local file system
+
+    Returns:
+        tuple: (filepath, status), status as for apply_message() or
+        "bad frame" if the header does not add up
+    """
+    payload = memoryview(payload)
+    _, version, path_len, length, crc = struct.unpack(FRAME_HEADER, payload[:FRAME_HEADER_SIZE])
+    start = FRAME_HEADER_SIZE + path_len
+    if version != FRAME_VERSION or len(payload) != start + length:
+        return None, "bad frame"
+    filepath = str(payload[FRAME_HEADER_SIZE:start], 'utf-8')
+    data = payload[start:]
+    if binascii.crc32(data) & 0xFFFFFFFF != crc:
+        return filepath, "crc mismatch"
+    if crc32_file(filepath) == crc:
+        return filepath, "unchanged"
+    _write_file(filepath, data)
+    return filepath, "ok"
+
+
+def replace(src, dst):
+    """Move src over dst, FatFs will not rename onto an existing file"""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def load_cached(filepath, cache_dir='.uplink_cache'):
+    """Contents last sent for filepath, None if it was never sent"""
+    try:
+        with open(_cache_path(filepath, cache_dir), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def save_cached(filepath, data, cache_dir='.uplink_cache'):
+    """Remember what was sent for filepath, the base of the next delta"""
+    try:
+        os.mkdir(cache_dir)
+    except OSError:
+        pass
+    with open(_cache_path(filepath, cache_dir), 'wb') as f:
+        f.write(data)
+
+
+def _cache_path(filepath, cache_dir):
+    return cache_dir + '/' + filepath.replace('/', '__')
+
+
+def _write_file(filepath, data):
+    tmp = filepath + ".new"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    replace(tmp, filepath)
+
+
+def _b64encode(data):
+    return binascii.b2a_base64(data).decode('ascii').strip()
+
+
+# Chunked uploads stream a file over <codetopic>/chunk as binary messages
+# and are acknowledged on <codetopic>/ack, so neither end holds the whole
+# file. Every message starts with CHUNK_MAGIC and a type byte:
+#   start: u32 size, u32 crc32, u16 chunk size, u16 path length, path
+#   data:  u32 sequence number, chunk bytes
+#   end:   u32 number of chunks
+# The receiver answers with {"next": n}, the first chunk it still needs,
+# whenever n reaches a multiple of the window and the first time a chunk
+# arrives past a gap at n, and answers the end with {"status": ...}.
+# Sender windows end on those multiples, so each one is acknowledged.
+CHUNK_MAGIC = b'UC'
+CHUNK_START = 0
+CHUNK_DATA = 1
+CHUNK_END = 2
+
+
+def chunk_start(filepath, size, crc, chunk_size):
+    path = filepath.encode('utf-8')
+    return struct.pack('>2sBIIHH', CHUNK_MAGIC, CHUNK_START, size, crc, chunk_size, len(path)) + path
+
+
+def chunk_data(seq, data):
+    return struct.pack('>2sBI', CHUNK_MAGIC, CHUNK_DATA, seq) + data
+
+
+def chunk_end(count):
+    return struct.pack('>2sBI', CHUNK_MAGIC, CHUNK_END, count)
+
+
+class UploadReceiver:
+    """Board side of a chunked upload
+
+    Chunks are written to filepath + ".part" as they arrive with a running
+    crc32, and the file is moved into place after the end message if its
+    size and crc32 match the start message.
+
+    Args:
+        window (int, optional): chunks per acknowledgement. Defaults to 8.
+    """
+
+    def __init__(self, window=8):
+        self.window = window
+        self.f = None
+        self.filepath = None
+
+    @property
+    def active(self):
+        return self.f is not None
+
+    def handle(self, payload):
+        """Process one chunk message
+
+        Returns:
+            dict: acknowledgement to publish, None if none is due
+        """
+        payload = memoryview(payload)
+        if len(payload) < 3 or bytes(payload[:2]) != CHUNK_MAGIC:
+            return None
+        kind = payload[2]
+        if kind == CHUNK_START:
+            self._abort()
+            size, crc, chunk_size, path_len = struct.unpack('>IIHH', payload[3:15])
+            self.filepath = str(payload[15:15 + path_len], 'utf-8')
+            self.size = size
+            self.crc = crc
+            self.count = (size + chunk_size - 1) // chunk_size
+            self.next = 0
+            # the last gap reported, so a burst past one gap is reported once
+            self.gap = None
+            self.running_crc = 0
+            self.written = 0
+            self.f = open(self.filepath + ".part", 'wb')
+            return self._ack()
+        if self.f is None:
+            return {"filepath": self.filepath, "status": "no upload"}
+        if kind == CHUNK_DATA:
+            seq = struct.unpack('>I', payload[3:7])[0]
+            if seq != self.next:
+                # a duplicate or a gap, tell the sender where we are once
+                if seq > self.next and self.gap != self.next:
+                    self.gap = self.next
+                    return self._ack()
+                return None
+            data = payload[7:]
+            self.f.write(data)
+            self.running_crc = binascii.crc32(data, self.running_crc)
+            self.written += len(data)
+            self.next += 1
+            if self.next % self.window == 0 or self.next == self.count:
+                return self._ack()
+            return None
+        if kind == CHUNK_END:
+            if self.next < self.count:
+                return self._ack()
+            self.f.close()
+            self.f = None
+            tmp = self.filepath + ".part"
+            if self.written != self.size or self.running_crc & 0xFFFFFFFF != self.crc:
+                os.remove(tmp)
+                status = "crc mismatch"
+            else:
+                replace(tmp, self.filepath)
+                status = "ok"
+            return {"filepath": self.filepath, "status": status, "crc": self.crc}
+        return None
+
+    def _ack(self):
+        return {"filepath": self.filepath, "next": self.next}
+
+    def _abort(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.filepath + ".part")
+
+
+class UploadSender:
+    """Sender side of a chunked upload, for CPython with a threaded MQTT client
+
+    Call on_ack() from the client's message callback with each decoded
+    acknowledgement. Windows that are not acknowledged in time are sent
+    again from the first chunk the board still needs.
+
+    Args:
+        publish (callable): publish(topic, payload), should use QoS 1
+        topic (str): the chunk topic, <codetopic>/chunk
+        chunk_size (int, optional): bytes per chunk message. Defaults to 4096.
+        window (int, optional): chunks in flight, must match the board. Defaults to 8.
+        timeout (float, optional): seconds to wait for an acknowledgement. Defaults to 10.
+        retries (int, optional): timeouts in a row before giving up. Defaults to 5.
+    """
+
+    def __init__(self, publish, topic, chunk_size=4096, window=8, timeout=10.0, retries=5):
+        import threading
+        self.publish = publish
+        self.topic = topic
+        self.chunk_size = chunk_size
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.next = None
+        self.status = None
+        # acknowledgements received, to tell a gap report from silence
+        self.acks = 0
+
+    def on_ack(self, ack):
+        with self.cond:
+            if "status" in ack:
+                self.status = ack["status"]
+            elif "next" in ack:
+                self.next = ack["next"]
+                self.acks += 1
+            self.cond.notify_all()
+
+    def send(self, filepath, data):
+        """Upload data to filepath on the board
+
+        Returns:
+            str: the board's final status, or "timeout"
+        """
+        crc = binascii.crc32(data) & 0xFFFFFFFF
+        count = (len(data) + self.chunk_size - 1) // self.chunk_size
+        with self.cond:
+            self.next = None
+            self.status = None
+        if not self._exchange(chunk_start(filepath, len(data), crc, self.chunk_size),
+                              lambda: self.next == 0):
+            return "timeout"
+        retries = self.retries
+        while self.next < count:
+            base = self.next
+            # end on the receiver's next multiple of window, where it acks
+            end = min((base // self.window + 1) * self.window, count)
+            with self.cond:
+                acks = self.acks
+            for seq in range(base, end):
+                chunk = data[seq * self.chunk_size:(seq + 1) * self.chunk_size]
+                self.publish(self.topic, chunk_data(seq, chunk))
+            with self.cond:
+                # any other acknowledgement in the window reports a gap
+                answered = self.cond.wait_for(lambda: self.next >= end or self.acks != acks, self.timeout)
+            if answered:
+                retries = self.retries
+            else:
+                retries -= 1
+                if not retries:
+                    return "timeout"
+        if not self._exchange(chunk_end(count), lambda: self.status is not None):
+            return "timeout"
+        return self.status
+
+    def _exchange(self, payload, done):
+        for _ in range(self.retries):
+            self.publish(self.topic, payload)
+            with self.cond:
+                if self.cond.wait_for(done, self.timeout):
+                    return True
+        return False
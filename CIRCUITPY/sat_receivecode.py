@@ -8,7 +8,7 @@ import adafruit_minimqtt.adafruit_minimqtt as MQTT
 import ssl
 import sys
 import json
-from base64 import b64decode
+import uplink
 
 
 def attempt_wifi():
@@ -68,16 +68,41 @@ def connected(client, userdata, flags, rc):
     # This function will be called when the client is connected
     # successfully to the broker.
     print("Connected to MQTT broker!")
-    client.subscribe(secrets['mqtt']['codetopic'])
+    client.subscribe([(secrets['mqtt']['codetopic'], 1), (secrets['mqtt']['codetopic'] + '/chunk', 1)])
+
+# chunked uploads stream straight to flash, see uplink.UploadReceiver
+upload = uplink.UploadReceiver()
 
 def mqtt_message(client, topic, payload):
     #print("[{}] {}".format(topic, payload))
-    payload = json.loads(payload)
-    with open(payload["filepath"], mode ='w', decoding='utf-8', errors='ignore') as stream: #CHANGES MADE HERE
-        stream.write(b64decode(payload["data"]))
-        print('done')
-    client.disconnect()
-    print('disconnected')
+    if topic == secrets['mqtt']['codetopic'] + '/chunk':
+        ack = upload.handle(payload)
+        if ack is not None:
+            client.publish(secrets['mqtt']['codetopic'] + '/ack', json.dumps(ack), qos=1)
+        if ack is None or "status" not in ack:
+            return
+        print(f"{ack['filepath']}: {ack['status']}")
+        if ack['status'] in ("ok", "unchanged"):
+            client.disconnect()
+            print('disconnected')
+        return
+    if uplink.is_frame(payload):
+        filepath, status = uplink.apply_frame(payload)
+    else:
+        # JSON messages from older senders and gs_sendcode.py patches
+        payload = json.loads(payload)
+        filepath = payload['filepath']
+        status = uplink.apply_message(payload)
+    print(f"{filepath}: {status}")
+    client.publish(
+        secrets['mqtt']['codetopic'] + '/status',
+        json.dumps({"filepath": filepath, "status": status, "crc": uplink.crc32_file(filepath) if filepath else None}),
+        qos=1
+    )
+    # stay connected after a rejected update, the sender follows up with the whole file
+    if status in ("ok", "unchanged"):
+        client.disconnect()
+        print('disconnected')
     
         
     
@@ -95,7 +120,9 @@ def set_up_mqtt(pool):
         password=secrets['mqtt']["password"],
         socket_pool=pool,
         is_ssl = True,
-        ssl_context=ssl.create_default_context()
+        ssl_context=ssl.create_default_context(),
+        # chunks are binary, and JSON parses from bytes as well
+        use_binary_mode=True
     )
 
     mqtt_client.on_connect = connected
@@ -113,4 +140,6 @@ while True:
     mqtt_client.loop()
     if(not mqtt_client.is_connected()):
         break
-    time.sleep(3)
+    # keep up with the sender while an upload is streaming in
+    if not upload.active:
+        time.sleep(3)
@@ -1,30 +1,97 @@
 import paho.mqtt.client as paho
 from CIRCUITPY.secrets import secrets
+from CIRCUITPY.lib import uplink
 import sys
 import json
+import threading
 
 
+# usage: python gs_sendcode.py <path on the board> [--full] [--chunked]
+# Sends a patch against the last version the board confirmed, or the
+# whole file with --full. The board checks the crc32 of its own copy and
+# answers on <codetopic>/status; on "base mismatch" the whole file is sent
+# instead, and the local copy of what the board has is only updated once
+# the board answers "ok" or "unchanged".
+# Whole files bigger than CHUNKED_MIN (or any with --chunked) are streamed
+# as acknowledged chunks instead, so the board never holds them in RAM.
+CHUNKED_MIN = 8192
+# seconds to wait for the board's answer to a message
+STATUS_TIMEOUT = 30
+
+connected = threading.Event()
+sender = None
+# the board's last /status message
+reply = {}
+replied = threading.Event()
+
 
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc, yyy):
     print("Connected with result code "+str(rc))
-    filepath = sys.argv[1]
-    file = open(f'CIRCUITPY/{filepath}','r')
-    payload = json.dumps({"filepath": filepath, "data": file.read()}).encode('utf-8')
-    client.publish(secrets['mqtt']['codetopic'], payload =payload , qos=0)
-    print("sent")
-    file.close()
-    client.disconnect()
-    print('disconnected')
+    client.subscribe([
+        (secrets['mqtt']['codetopic'] + '/ack', 1),
+        (secrets['mqtt']['codetopic'] + '/status', 1),
+    ])
+    connected.set()
+
+def on_message(client, userdata, msg):
+    if msg.topic == secrets['mqtt']['codetopic'] + '/status':
+        reply.clear()
+        reply.update(json.loads(msg.payload))
+        replied.set()
+    else:
+        sender.on_ack(json.loads(msg.payload))
+
+def send_message(client, message):
+    """Publish a JSON message and return the board's status for it"""
+    payload = json.dumps(message).encode('utf-8')
+    replied.clear()
+    client.publish(secrets['mqtt']['codetopic'], payload =payload , qos=1).wait_for_publish()
+    print(f"sent {message['mode']} update, {len(payload)} bytes")
+    while replied.wait(STATUS_TIMEOUT):
+        replied.clear()
+        if reply.get('filepath') == message['filepath']:
+            return reply['status']
+    return "timeout"
+
+def send_full(client, filepath, target):
+    if len(target) > CHUNKED_MIN or '--chunked' in sys.argv:
+        print(f"chunked upload of {len(target)} bytes")
+        return sender.send(filepath, target)
+    return send_message(client, uplink.build_message(filepath, target))
+
+def send_code(client, filepath):
+    with open(f'CIRCUITPY/{filepath}','rb') as file:
+        target = file.read()
+    base = None if '--full' in sys.argv else uplink.load_cached(filepath)
+    message = uplink.build_message(filepath, target, base)
+    if message['mode'] == 'delta':
+        status = send_message(client, message)
+        if status == 'base mismatch':
+            print("the board has a different version, sending the whole file")
+            status = send_full(client, filepath, target)
+    else:
+        status = send_full(client, filepath, target)
+    print(f"{filepath}: {status}")
+    if status in ('ok', 'unchanged'):
+        uplink.save_cached(filepath, target)
 
 client = paho.Client(client_id="", userdata=None, protocol=paho.MQTTv5)
 client.tls_set(tls_version=paho.ssl.PROTOCOL_TLS)
 client.username_pw_set(secrets["mqtt"]["username"],secrets['mqtt']['password'])
-client.connect(secrets['mqtt']['broker'], secrets['mqtt']['port'])
-
+sender = uplink.UploadSender(
+    lambda topic, payload: client.publish(topic, payload, qos=1),
+    secrets['mqtt']['codetopic'] + '/chunk'
+)
 client.on_connect = on_connect
+client.on_message = on_message
+client.connect(secrets['mqtt']['broker'], secrets['mqtt']['port'])
 
-# Blocking call that processes network traffic, dispatches callbacks and
-# handles reconnecting.
-# Other loop*() functions are available that give   a threaded interface and a
-client.loop_forever()
\ No newline at end of file
+# Network traffic and callbacks run on paho's thread while this one waits
+# for acknowledgements.
+client.loop_start()
+connected.wait()
+send_code(client, sys.argv[1])
+client.disconnect()
+client.loop_stop()
+print('disconnected')
@@ -3,36 +3,60 @@ import busio
 from adafruit_lsm6ds.lsm6dsox import LSM6DSOX
 from picamera2 import Picamera2 #need to install?
 import time
-import math
 from datetime import datetime
-import os
-from PIL import Image
+import queue
+import threading
+from uploader import Uploader
+from shake import ShakeDetector
 
 
 i2c = busio.I2C(board.SCL, board.SDA)
 sensor1 = LSM6DSOX(i2c)
 camera = Picamera2()
+# keep the sensor running at the size we send, so a picture is one frame
+# grab and one JPEG encode instead of a restart, an encode, a decode and
+# a second encode
+IMAGE_SIZE = (320, 240)
+camera.configure(camera.create_still_configuration(main={"size": IMAGE_SIZE}))
+camera.start()
 THRESHOLD = 18
+# encode and send pictures on a worker thread so the IMU loop keeps going
+ENCODE_IN_THREAD = True
+# False leaves sending to ingest.py, which watches pi_images_to_send
+SEND_DIRECTLY = False
+# one MQTT session for every picture, see uploader.py
+uploader = Uploader().start() if SEND_DIRECTLY else None
 max = 0
 
+def save_and_send(image, filepath):
+    image.convert('RGB').save(filepath, quality=90)
+    if SEND_DIRECTLY:
+        print('sending to mqtt')
+        uploader.enqueue(filepath)
+
+def encoder():
+    while True:
+        save_and_send(*encode_queue.get())
+
+encode_queue = queue.Queue(4)
+if ENCODE_IN_THREAD:
+    threading.Thread(target=encoder, daemon=True).start()
+
+# samples at 416 Hz in batches, see shake.py
+detector = ShakeDetector(sensor1, threshold=THRESHOLD)
+
 print('shake imu to take picture')
 while True:
-    accelx, accely, accelz = sensor1.acceleration
-    accelz = accelz - 9.8
-    accel_value = math.sqrt(math.pow(accelx, 2)+ math.pow(accely, 2)+ math.pow(accelz, 2))
-    if(accel_value > THRESHOLD):
+    if detector.poll():
         print('taking pic in 5 seconds get ready!')
         time.sleep(5)
         filename = f'pi_images_to_send/{datetime.now().strftime("%Y%m%d%H%M%S")}.jpg'
-        camera.start_and_capture_file(filename, show_preview =False)
         filepath = f'/home/kaitlyntseng/Programming/Communications/{filename}'
-        camera.stop()
-        print('resizing image')
-        resized_image = Image.open(filepath)
-        new_image = resized_image.resize((320, 240))
-        new_image.save(filepath)
-        print('sending to mqtt')
-        os.system(f'python /home/kaitlyntseng/Programming/Communications/pi_sendcode.py {filepath}')
-    time.sleep(1)
+        image = camera.capture_image("main")
+        if ENCODE_IN_THREAD:
+            encode_queue.put((image, filepath))
+        else:
+            save_and_send(image, filepath)
+        detector.reset()
 
 
@@ -0,0 +1,181 @@
+import os
+import io
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from PIL import Image
+from uploader import Uploader
+
+
+# Watches pi_images_to_send and sends every new picture once. imu.py only
+# has to save into the folder.
+WATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pi_images_to_send')
+# one "<sha256> <name>" line per delivered picture, survives restarts
+DONE_INDEX = os.path.join(WATCH_DIR, '.done')
+# a file is complete once its size has not changed for this long
+SETTLE_TIME = 0.5
+# a file still without a JPEG end marker this long after it settled is dropped
+GIVE_UP_TIME = 60
+IMAGE_SIZE = (320, 240)
+WORKERS = 2
+# pictures being prepared or waiting on the uploader before new ones wait
+MAX_PENDING = 8
+
+def is_jpg_or_jpeg(filename):
+    return filename.lower().endswith(('.jpg', '.jpeg'))
+
+class MyHandler(FileSystemEventHandler):
+    """Notes every jpg that is created, written to or moved in"""
+
+    def __init__(self, ingest):
+        super().__init__()
+        self.ingest = ingest
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.ingest.seen(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.ingest.seen(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.ingest.seen(event.dest_path)
+
+class Ingest:
+    """Debounces new pictures, skips ones already sent and hands the rest to workers
+
+    A file is taken once its size has held still for SETTLE_TIME and it
+    ends in a JPEG end of image marker. Workers hash it, resize it if it is
+    larger than IMAGE_SIZE and queue it on the uploader, and its hash goes
+    into DONE_INDEX once the broker has it. At most MAX_PENDING pictures
+    are in the pipeline, the rest wait here until a slot frees up.
+    """
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self.pool = ThreadPoolExecutor(max_workers=WORKERS)
+        self.slots = threading.Semaphore(MAX_PENDING)
+        self.lock = threading.Lock()
+        # path -> (size, time the size was last seen to change)
+        self.waiting = {}
+        # hashes of pictures being sent, so a copy that turns up meanwhile is skipped
+        self.busy = set()
+        self.done = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(DONE_INDEX) as f:
+                return {line.split()[0] for line in f if line.strip()}
+        except OSError:
+            return set()
+
+    def mark_done(self, digest, path):
+        with self.lock:
+            self.busy.discard(digest)
+            self.done.add(digest)
+            with open(DONE_INDEX, 'a') as f:
+                f.write(f"{digest} {os.path.basename(path)}\n")
+                f.flush()
+                os.fsync(f.fileno())
+        self.slots.release()
+
+    def seen(self, path):
+        if is_jpg_or_jpeg(path):
+            with self.lock:
+                self.waiting[path] = (-1, time.monotonic())
+
+    def scan(self):
+        """Pick up pictures left from before a restart"""
+        for name in sorted(os.listdir(WATCH_DIR)):
+            self.seen(os.path.join(WATCH_DIR, name))
+
+    def poll(self):
+        """Submit every file that has settled, call this regularly"""
+        now = time.monotonic()
+        with self.lock:
+            waiting = list(self.waiting.items())
+        for path, (size, changed) in waiting:
+            try:
+                current = os.path.getsize(path)
+            except OSError:
+                with self.lock:
+                    self.waiting.pop(path, None)
+                continue
+            if current != size:
+                with self.lock:
+                    self.waiting[path] = (current, now)
+                continue
+            if now - changed < SETTLE_TIME:
+                continue
+            if not self.complete(path):
+                if now - changed > GIVE_UP_TIME:
+                    print(f"[WARNING] {path} never ended in a JPEG end marker, skipped")
+                    with self.lock:
+                        self.waiting.pop(path, None)
+                continue
+            if not self.slots.acquire(blocking=False):
+                # backpressure, try again on the next poll
+                return
+            with self.lock:
+                self.waiting.pop(path, None)
+            self.pool.submit(self.process, path)
+
+    def complete(self, path):
+        # the file may be renamed or deleted under us, a new event brings it back
+        try:
+            with open(path, 'rb') as f:
+                f.seek(-2, os.SEEK_END)
+                return f.read(2) == b'\xff\xd9'
+        except OSError:
+            return False
+
+    def process(self, path):
+        digest = None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            with self.lock:
+                if digest in self.done or digest in self.busy:
+                    print(f"already sent {path}")
+                    self.slots.release()
+                    return
+                self.busy.add(digest)
+            image = Image.open(io.BytesIO(data))
+            if image.width > IMAGE_SIZE[0] or image.height > IMAGE_SIZE[1]:
+                image.thumbnail(IMAGE_SIZE)
+                out = io.BytesIO()
+                image.convert('RGB').save(out, 'JPEG', quality=90)
+                data = out.getvalue()
+            self.uploader.enqueue(path, data=data, on_delivered=lambda p: self.mark_done(digest, p))
+        except Exception as e:
+            print(f"[WARNING] {path}: {e}")
+            with self.lock:
+                self.busy.discard(digest)
+            self.slots.release()
+
+if __name__ == "__main__":
+    uploader = Uploader().start()
+    ingest = Ingest(uploader)
+    handler = MyHandler(ingest)
+    observer = Observer()
+    observer.schedule(handler, path=WATCH_DIR, recursive=False)
+
+    observer.start()
+    ingest.scan()
+
+    try:
+        while True:
+            ingest.poll()
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        observer.stop()
+
+    observer.join()
+    ingest.pool.shutdown()
+    uploader.stop()
@@ -1,30 +1,47 @@
 import paho.mqtt.client as paho
 from CIRCUITPY.secrets import secrets
+from CIRCUITPY.lib import uplink
 import sys
 import json
 
 
+# usage: python pi_sendcode.py <filepath> [--json]
+# Sends the file as a binary frame (see uplink.build_frame), --json sends
+# the old {"filepath", "data"} text message for boards without uplink.py.
+# To send many files over one connection use uploader.Uploader instead.
+
+def make_client():
+    """paho client set up with the broker credentials, not yet connected"""
+    client = paho.Client(client_id="", userdata=None, protocol=paho.MQTTv5)
+    client.tls_set(tls_version=paho.ssl.PROTOCOL_TLS)
+    client.username_pw_set(secrets["mqtt"]["username"],secrets['mqtt']['password'])
+    return client
+
+def build_payload(filepath, use_json=False, remote_path=None):
+    """Message that writes the file at filepath to remote_path (default filepath) on the board"""
+    remote_path = remote_path or filepath
+    if use_json:
+        with open(filepath,mode ='r', encoding='utf-8', errors='ignore') as file:
+            return json.dumps({"filepath": remote_path, "data": file.read()}).encode('utf-8')
+    with open(filepath,'rb') as file:
+        return uplink.build_frame(remote_path, file.read())
 
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc, yyy):
     print("Connected with result code "+str(rc))
-    filepath = sys.argv[1]
-    file = open(filepath,mode ='r', encoding='utf-8', errors='ignore')
-    payload = json.dumps({"filepath": filepath, "data": file.read()}).encode('utf-8')
+    payload = build_payload(sys.argv[1], use_json='--json' in sys.argv)
     client.publish(secrets['mqtt']['codetopic'], payload =payload , qos=0)
-    print("sent")
-    file.close()
+    print(f"sent {len(payload)} bytes")
     client.disconnect()
     print('disconnected')
 
-client = paho.Client(client_id="", userdata=None, protocol=paho.MQTTv5)
-client.tls_set(tls_version=paho.ssl.PROTOCOL_TLS)
-client.username_pw_set(secrets["mqtt"]["username"],secrets['mqtt']['password'])
-client.connect(secrets['mqtt']['broker'], secrets['mqtt']['port'])
+if __name__ == "__main__":
+    client = make_client()
+    client.connect(secrets['mqtt']['broker'], secrets['mqtt']['port'])
 
-client.on_connect = on_connect
+    client.on_connect = on_connect
 
-# Blocking call that processes network traffic, dispatches callbacks and
-# handles reconnecting.
-# Other loop*() functions are available that give   a threaded interface and a
-client.loop_forever()
\ No newline at end of file
+    # Blocking call that processes network traffic, dispatches callbacks and
+    # handles reconnecting.
+    # Other loop*() functions are available that give   a threaded interface and a
+    client.loop_forever()
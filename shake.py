@@ -0,0 +1,130 @@
+import time
+import numpy as np
+from adafruit_lsm6ds import AccelRange, Rate
+
+# LSM6DSOX FIFO registers, see the datasheet and AN5272
+FIFO_CTRL1 = 0x07
+FIFO_CTRL4 = 0x0A
+FIFO_STATUS1 = 0x3A
+FIFO_DATA_OUT_TAG = 0x78
+# FIFO_CTRL4 modes, bypass also empties the FIFO
+FIFO_BYPASS = 0x00
+FIFO_CONTINUOUS = 0x06
+# one FIFO word is a tag byte and the X, Y, Z registers, little endian
+FIFO_WORD = np.dtype([('tag', 'u1'), ('xyz', '<i2', (3,))])
+MILLI_G_TO_ACCEL = 0.00980665
+
+
+class ShakeDetector:
+    """Detects shakes from a batch of accelerometer samples at a time
+
+    The sensor queues accelerometer samples at `rate` Hz in its hardware
+    FIFO. poll() sleeps until `batch` samples are queued, reads them in one
+    I2C burst, adds their magnitudes to a preallocated ring of the last
+    `window` and checks the whole window at once with NumPy. A shake is at
+    least `min_samples` samples over `threshold`, and shakes closer than
+    `debounce` seconds to the last one are ignored.
+
+    Args:
+        sensor (LSM6DSOX): accelerometer
+        threshold (float, optional): magnitude in m/s^2 once gravity is taken off z. Defaults to 18.
+        rate (int, optional): samples per second. Defaults to 416.
+        batch (int, optional): samples read per poll(). Defaults to 8.
+        window (int, optional): samples kept for detection. Defaults to 64.
+        min_samples (int, optional): samples over threshold for a shake. Defaults to 2.
+        debounce (float, optional): seconds between shakes. Defaults to 2.0.
+        gravity (float, optional): taken off the z axis, as the sensor sits flat. Defaults to 9.8.
+    """
+
+    RATES = {
+        104: Rate.RATE_104_HZ,
+        208: Rate.RATE_208_HZ,
+        416: Rate.RATE_416_HZ,
+        833: Rate.RATE_833_HZ,
+        1666: Rate.RATE_1_66K_HZ,
+    }
+    # BDR_XL in FIFO_CTRL3, the rate accelerometer samples enter the FIFO
+    BATCH_RATES = {104: 0x4, 208: 0x5, 416: 0x6, 833: 0x7, 1666: 0x8}
+
+    def __init__(self, sensor, threshold=18, rate=416, batch=8, window=64,
+                 min_samples=2, debounce=2.0, gravity=9.8):
+        self.sensor = sensor
+        # the sensor samples at this rate and every sample is queued
+        sensor.accelerometer_data_rate = self.RATES[rate]
+        self.batch_rate = self.BATCH_RATES[rate]
+        self.scale = AccelRange.lsb[sensor.accelerometer_range] * MILLI_G_TO_ACCEL
+        self.threshold = threshold
+        self.period = 1.0 / rate
+        self.batch = batch
+        self.min_samples = min_samples
+        self.debounce = debounce
+        self.offset = np.array((0.0, 0.0, gravity), dtype=np.float32)
+        # the burst read lands in buf, words is a view of it
+        self.buf = bytearray(batch * FIFO_WORD.itemsize)
+        self.words = np.frombuffer(self.buf, dtype=FIFO_WORD)
+        self.status = bytearray(2)
+        self.raw = np.zeros((batch, 3), dtype=np.float32)
+        self.magnitudes = np.zeros(window, dtype=np.float32)
+        self.pos = 0
+        self.last_shake = float('-inf')
+        self.start_fifo()
+
+    def start_fifo(self):
+        """Empty the FIFO and queue accelerometer samples only, newest kept when full"""
+        with self.sensor.i2c_device as i2c:
+            i2c.write(bytes((FIFO_CTRL4, FIFO_BYPASS)))
+            # FIFO_CTRL1 to FIFO_CTRL4 in one write: a watermark of one
+            # batch, accelerometer batch rate, no gyroscope, timestamp or
+            # temperature words
+            i2c.write(bytes((
+                FIFO_CTRL1,
+                self.batch & 0xFF,
+                (self.batch >> 8) & 0x01,
+                self.batch_rate,
+                FIFO_CONTINUOUS,
+            )))
+
+    def fifo_level(self):
+        """Words waiting in the FIFO, from FIFO_STATUS1 and FIFO_STATUS2"""
+        with self.sensor.i2c_device as i2c:
+            i2c.write_then_readinto(bytes((FIFO_STATUS1,)), self.status)
+        return self.status[0] | (self.status[1] & 0x03) << 8
+
+    def read_batch(self):
+        """Wait for a batch of samples in the FIFO and read it in one burst"""
+        level = self.fifo_level()
+        while level < self.batch:
+            time.sleep((self.batch - level) * self.period)
+            level = self.fifo_level()
+        # the register address wraps from FIFO_DATA_OUT_Z_H back to the
+        # tag, so one read takes every word of the batch
+        with self.sensor.i2c_device as i2c:
+            i2c.write_then_readinto(bytes((FIFO_DATA_OUT_TAG,)), self.buf)
+        raw = self.raw
+        np.multiply(self.words['xyz'], self.scale, out=raw)
+        raw -= self.offset
+        mags = np.sqrt(np.einsum('ij,ij->i', raw, raw))
+        # copy into the ring, split in two where it wraps
+        n = len(mags)
+        first = min(n, len(self.magnitudes) - self.pos)
+        self.magnitudes[self.pos:self.pos + first] = mags[:first]
+        self.magnitudes[:n - first] = mags[first:]
+        self.pos = (self.pos + n) % len(self.magnitudes)
+
+    def poll(self):
+        """Read a batch, True if it completes a shake"""
+        self.read_batch()
+        if np.count_nonzero(self.magnitudes > self.threshold) < self.min_samples:
+            return False
+        now = time.monotonic()
+        if now - self.last_shake < self.debounce:
+            return False
+        self.last_shake = now
+        self.reset()
+        return True
+
+    def reset(self):
+        """Forget the samples so far, call after a pause in polling"""
+        self.magnitudes[:] = 0
+        self.pos = 0
+        self.start_fifo()
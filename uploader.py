@@ -0,0 +1,133 @@
+import sys
+import time
+import queue
+import threading
+from CIRCUITPY.secrets import secrets
+from CIRCUITPY.lib import uplink
+from pi_sendcode import make_client, build_payload
+
+
+class Uploader:
+    """Publishes files to the code topic over one long lived MQTT session
+
+    enqueue() returns at once and a worker thread publishes the files back
+    to back as binary frames. With QoS 1 up to max_inflight publishes are
+    left unacknowledged at a time instead of waiting for each PUBACK, and
+    paho resends them if the connection drops and comes back.
+
+    Args:
+        qos (int, optional): MQTT QoS of the publishes. Defaults to 1.
+        max_inflight (int, optional): unacknowledged publishes at a time. Defaults to 8.
+        maxsize (int, optional): files waiting to be sent before enqueue() blocks. Defaults to 64.
+        log (bool, optional): print every delivery. Defaults to True.
+    """
+
+    def __init__(self, qos=1, max_inflight=8, maxsize=64, log=True):
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.log = log
+        self.queue = queue.Queue(maxsize)
+        self.connected = threading.Event()
+        # mid -> (filepath, time enqueued, on_delivered), guarded by cond
+        self.inflight = {}
+        # mids acknowledged before publish() returned to us
+        self.early = set()
+        self.cond = threading.Condition()
+        self.client = make_client()
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.worker = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Connect in the background and start the worker"""
+        self.client.connect_async(secrets['mqtt']['broker'], secrets['mqtt']['port'])
+        self.client.loop_start()
+        self.worker.start()
+        return self
+
+    def enqueue(self, filepath, remote_path=None, data=None, on_delivered=None):
+        """Queue a file for upload
+
+        Args:
+            filepath (str): file to send
+            remote_path (str, optional): path on the board. Defaults to filepath.
+            data (bytes, optional): contents to send instead of reading filepath.
+            on_delivered (callable, optional): called with filepath from paho's
+                thread once the broker has the file (sent, for QoS 0).
+        """
+        self.queue.put((filepath, remote_path, data, on_delivered, time.monotonic()))
+
+    def stop(self, timeout=30.0):
+        """Send what is queued, wait for the acknowledgements and disconnect"""
+        self.queue.put(None)
+        self.worker.join(timeout)
+        with self.cond:
+            self.cond.wait_for(lambda: not self.inflight, timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        print("Connected with result code "+str(rc))
+        self.connected.set()
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        print("Disconnected with result code "+str(rc))
+        self.connected.clear()
+
+    def on_publish(self, client, userdata, mid):
+        with self.cond:
+            entry = self.inflight.pop(mid, None)
+            # QoS 0 publishes are reported by run() and never wait in inflight
+            if entry is None and self.qos:
+                self.early.add(mid)
+            self.cond.notify_all()
+        if entry is not None:
+            self.delivered(*entry)
+
+    def delivered(self, filepath, queued, on_delivered):
+        if self.log: print(f"delivered {filepath} in {time.monotonic() - queued:.2f}s")
+        if on_delivered is not None:
+            on_delivered(filepath)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            filepath, remote_path, data, on_delivered, queued = item
+            try:
+                if data is None:
+                    payload = build_payload(filepath, remote_path=remote_path)
+                else:
+                    payload = uplink.build_frame(remote_path or filepath, data)
+            except OSError as e:
+                print(f"[WARNING] cannot read {filepath}: {e}")
+                continue
+            self.connected.wait()
+            with self.cond:
+                # paho queues past its own inflight limit, keep that queue short
+                self.cond.wait_for(lambda: len(self.inflight) < self.max_inflight)
+            # not under cond, paho calls on_publish holding its own locks
+            info = self.client.publish(secrets['mqtt']['codetopic'], payload, qos=self.qos)
+            entry = (filepath, queued, on_delivered)
+            if not self.qos:
+                self.delivered(*entry)
+                continue
+            with self.cond:
+                early = info.mid in self.early
+                if early:
+                    self.early.discard(info.mid)
+                else:
+                    self.inflight[info.mid] = entry
+            if early:
+                self.delivered(*entry)
+
+
+if __name__ == "__main__":
+    # usage: python uploader.py <filepath>...
+    uploader = Uploader().start()
+    for filepath in sys.argv[1:]:
+        uploader.enqueue(filepath)
+    uploader.stop()